@@ -0,0 +1,268 @@
+"""Micro-benchmarks for the training stack.
+
+    python benchmark.py channels_last --model deeplabv3plus_resnet101 --batch_size 2 --crop_size 513
+    python benchmark.py compile --model deeplabv3plus_resnet101 --batch_size 2 --crop_size 513
+    python benchmark.py pgc_loss --batch_size 8 --crop_size 513
+    python benchmark.py consistency --batch_size 8 --crop_size 513
+
+Every subcommand builds its models without downloading pretrained weights
+and runs on CPU unless ``--device`` says otherwise.
+"""
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+import network
+from metrics.losses import PGC_loss, PGCTermLoss, build_pgc_terms, overlap_consistency
+
+MODELS = {
+    'deeplabv3_resnet50': network.deeplabv3_resnet50,
+    'deeplabv3plus_resnet50': network.deeplabv3plus_resnet50,
+    'deeplabv3_resnet101': network.deeplabv3_resnet101,
+    'deeplabv3plus_resnet101': network.deeplabv3plus_resnet101,
+    'deeplabv3_mobilenet': network.deeplabv3_mobilenet,
+    'deeplabv3plus_mobilenet': network.deeplabv3plus_mobilenet
+}
+
+
+def build_model(opts, **kwargs):
+    model = MODELS[opts.model](num_classes=opts.num_classes, output_stride=opts.output_stride,
+                               pretrained_backbone=False, **kwargs)
+    return model.to(opts.device)
+
+
+def as_list(outputs):
+    """DeepLabV3+ returns the feature pyramid as a list, DeepLabV3 a single tensor."""
+    return outputs if isinstance(outputs, (list, tuple)) else [outputs]
+
+
+def time_model(model, images, iters, warmup, train=False):
+    """Images/sec of ``iters`` forward (and backward with ``train``) passes after ``warmup`` untimed ones."""
+    model.train(train)
+    device = images.device
+    for i in range(warmup + iters):
+        if i == warmup:
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+        if train:
+            model.zero_grad(set_to_none=True)
+            sum(o.float().mean() for o in as_list(model(images))).backward()
+        else:
+            with torch.no_grad():
+                model(images)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return iters * images.shape[0] / (time.perf_counter() - start)
+
+
+def check_channels_last(model, images):
+    """Run one forward pass and return the conv layers whose input was not channels_last.
+
+    Catches layout breaks anywhere between the input and the head, e.g. in
+    IntermediateLayerGetter, the ASPP pooling branch or the decoder's
+    F.interpolate/torch.cat.
+    """
+    broken = []
+
+    def hook(name):
+        def fn(module, inputs):
+            x = inputs[0]
+            if x.shape[-1] * x.shape[-2] > 1 and not x.is_contiguous(memory_format=torch.channels_last):
+                broken.append(name)
+        return fn
+
+    handles = [m.register_forward_pre_hook(hook(name)) for name, m in model.named_modules()
+               if isinstance(m, nn.Conv2d)]
+    model.eval()
+    with torch.no_grad():
+        outputs = model(images)
+    for h in handles:
+        h.remove()
+    for i, o in enumerate(as_list(outputs)):
+        if o.dim() == 4 and not o.is_contiguous(memory_format=torch.channels_last):
+            broken.append('output[%d]' % i)
+    return broken
+
+
+def bench_channels_last(opts):
+    torch.manual_seed(0)
+    images = torch.randn(opts.batch_size, 3, opts.crop_size, opts.crop_size, device=opts.device)
+    results = {}
+    for channels_last in (False, True):
+        model = build_model(opts, channels_last=channels_last)
+        x = images.contiguous(memory_format=torch.channels_last) if channels_last else images
+        if channels_last:
+            broken = check_channels_last(model, x)
+            print('channels_last kept through the whole model' if not broken else
+                  'channels_last lost before: %s' % ', '.join(broken))
+        rate = time_model(model, x, opts.iters, opts.warmup, train=opts.train)
+        results[channels_last] = rate
+        print('%-14s %8.2f img/s' % ('channels_last' if channels_last else 'contiguous', rate))
+    print('speedup: %.2fx' % (results[True] / results[False]))
+
+
+def bench_compile(opts):
+    network.check_compile()
+    torch.manual_seed(0)
+    images = torch.randn(opts.batch_size, 3, opts.crop_size, opts.crop_size, device=opts.device)
+    model = build_model(opts).eval()
+    typed = network.TypedSegmentationModel.from_model(model)
+    variants = [('eager', model), ('compiled', torch.compile(typed, mode=opts.compile_mode))]
+    if not opts.train:
+        variants.append(('scripted', torch.jit.script(typed)))
+
+    with torch.no_grad():
+        reference = as_list(model(images))[-1]
+    results = {}
+    for name, m in variants:
+        # first call includes tracing/compilation
+        m.eval()
+        start = time.perf_counter()
+        with torch.no_grad():
+            diff = (as_list(m(images))[-1] - reference).abs().max().item()
+        first = time.perf_counter() - start
+        rate = time_model(m, images, opts.iters, opts.warmup, train=opts.train)
+        results[name] = rate
+        print('%-9s %8.2f img/s  first call %6.2fs  max |diff| %.3g' % (name, rate, first, diff))
+    for name in results:
+        if name != 'eager':
+            print('%s speedup: %.2fx' % (name, results[name] / results['eager']))
+
+
+def random_pairs(num_pairs, crop_size, generator):
+    """Overlap boxes of equal size at random places in both views, random flips, one empty overlap."""
+    overlap, flips = [], []
+    for i in range(num_pairs):
+        h, w = (int(torch.randint(1, crop_size + 1, (1,), generator=generator)) for _ in range(2))
+        if i == num_pairs - 1:
+            h = 0
+        boxes = []
+        for _ in range(2):
+            y, x = (int(torch.randint(0, crop_size - s + 1, (1,), generator=generator)) for s in (h, w))
+            boxes.append([[y, x], [y + h, x + w]])
+        overlap.append(boxes)
+        flips.append(-1 if torch.rand(1, generator=generator).item() < 0.5 else 1)
+    return overlap, flips
+
+
+def pgc_inputs(opts, generator):
+    """Random DeepLabV3+ pyramid [res_out, cat_feature, prev_result, result] of both views and labels."""
+    n, s = opts.batch_size, opts.crop_size
+    shapes = [(2048, s // 16 + 1), (256, s // 4 + 1), (256, s // 4 + 1), (opts.num_classes, s)]
+    outputs = [[torch.randn(n, c, size, size, generator=generator).to(opts.device).requires_grad_()
+                for _ in range(2)] for c, size in shapes]
+    labels = torch.randint(0, opts.num_classes, (2 * n, s, s), generator=generator).to(opts.device)
+    labels[:, :s // 8] = 255
+    return outputs, labels
+
+
+class TrainingLoss(object):
+    """The weighted loss main.py trains with, from PGC_loss or from the loss terms."""
+
+    def __init__(self, criterion, alpha=0.2, beta=0.9):
+        self.criterion = criterion
+        self.alpha, self.beta = alpha, beta
+
+    def __call__(self, outputs, overlap, flips, labels):
+        if isinstance(self.criterion, PGCTermLoss):
+            return [self.criterion.combine(self.criterion(outputs, overlap, flips, labels))[0]]
+        mse, sym_ce, mid_mse, mid_ce, mid_l1, ce = self.criterion(outputs, overlap, flips, labels)
+        return [ce + self.beta * sym_ce + self.alpha * sum(mid_mse)]
+
+
+def bench_pgc_loss(opts):
+    """Time the training loss of the reference loop, of the loss terms and of --pgc_points.
+
+    Parity of the loss terms with the loop is checked by tests/test_losses.py.
+    """
+    generator = torch.Generator().manual_seed(0)
+    outputs, labels = pgc_inputs(opts, generator)
+    overlap, flips = random_pairs(opts.batch_size, opts.crop_size, generator)
+    leaves = [t for level in outputs for t in level]
+    losses = (('loop', TrainingLoss(PGC_loss())),
+              ('terms', TrainingLoss(PGCTermLoss(build_pgc_terms()))),
+              ('points', TrainingLoss(PGCTermLoss(build_pgc_terms(), num_points=opts.points))))
+    for name, criterion in losses:
+        for i in range(opts.warmup + opts.iters):
+            if i == opts.warmup:
+                if opts.device.type == 'cuda':
+                    torch.cuda.synchronize(opts.device)
+                start = time.perf_counter()
+            loss = sum(criterion(outputs, overlap, flips, labels))
+            if opts.train:
+                torch.autograd.grad(loss, leaves, allow_unused=True)
+        if opts.device.type == 'cuda':
+            torch.cuda.synchronize(opts.device)
+        print('%-9s %8.2f ms/step' % (name, 1000 * (time.perf_counter() - start) / opts.iters))
+
+
+def bench_consistency(opts):
+    """Time SymmetricConsistency against the unfused ops on a --batch_size x --crop_size prediction.
+
+    Its gradcheck and parity with the unfused ops are in tests/test_losses.py.
+    """
+    generator = torch.Generator().manual_seed(0)
+    outputs, _ = pgc_inputs(opts, generator)
+    overlap, flips = random_pairs(opts.batch_size, opts.crop_size, generator)
+    output1, output2 = outputs[-1]
+    boxes = torch.as_tensor(overlap, dtype=torch.int64)
+    flips = torch.as_tensor(flips, dtype=torch.int64)
+    for fused in (False, True):
+        for i in range(opts.warmup + opts.iters):
+            if i == opts.warmup:
+                if opts.device.type == 'cuda':
+                    torch.cuda.synchronize(opts.device)
+                start = time.perf_counter()
+            values = overlap_consistency(output1, output2, boxes, flips, kinds=('mse', 'sym_ce'), fused=fused)
+            torch.autograd.grad(values['mse'] + values['sym_ce'], [output1, output2])
+        if opts.device.type == 'cuda':
+            torch.cuda.synchronize(opts.device)
+        print('%-7s %8.2f ms forward + backward' % ('fused' if fused else 'unfused',
+                                                     1000 * (time.perf_counter() - start) / opts.iters))
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description='PGC micro-benchmarks')
+    parser.add_argument('--model', type=str, default='deeplabv3plus_resnet101', choices=sorted(MODELS))
+    parser.add_argument('--num_classes', type=int, default=21)
+    parser.add_argument('--output_stride', type=int, default=16, choices=[8, 16])
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads for CPU runs')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--crop_size', type=int, default=513)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--train', action='store_true', default=False, help='time forward + backward')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subparsers.add_parser('channels_last', help='contiguous vs channels_last throughput'
+                          ).set_defaults(func=bench_channels_last)
+    compile_parser = subparsers.add_parser('compile', help='eager vs torch.compile vs TorchScript throughput '
+                                                           '(scripted runs are inference only)')
+    compile_parser.add_argument('--compile_mode', type=str, default='default',
+                                choices=['default', 'reduce-overhead', 'max-autotune'])
+    compile_parser.set_defaults(func=bench_compile)
+    pgc_parser = subparsers.add_parser('pgc_loss', help='speed of the PGC loss terms against the reference loop '
+                                                        '(--batch_size pairs, --train adds backward)')
+    pgc_parser.add_argument('--points', type=int, default=1024, help='points per overlap of the timed --pgc_points loss')
+    pgc_parser.set_defaults(func=bench_pgc_loss)
+    subparsers.add_parser('consistency', help='fused symmetric CE + MSE against the unfused ops on a '
+                                              '--batch_size x --crop_size prediction'
+                          ).set_defaults(func=bench_consistency)
+    return parser
+
+
+def main():
+    opts = get_argparser().parse_args()
+    opts.device = torch.device(opts.device)
+    if opts.threads is not None:
+        torch.set_num_threads(opts.threads)
+    opts.func(opts)
+
+
+if __name__ == '__main__':
+    main()
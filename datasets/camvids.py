@@ -5,10 +5,13 @@ from __future__ import print_function
 
 import os
 import numpy as np
+import torch
 from PIL import Image
 from torch.utils import data
 from torchvision import transforms
 
+from .manifest import load_or_build, file_stamp
+
 
 __all__ = ['CamvidSegmentation', 'get_norm']
 
@@ -43,7 +46,12 @@ class CamvidSegmentation(data.Dataset):
 				 root,
 				 image_set='train',
 				 transform=None,
-				 num_copys=1):
+				 num_copys=1,
+				 manifest_dir=None):
+		"""
+		manifest_dir: optional directory for a cached manifest of this split (datasets.manifest),
+		              read instead of the file list while it is unchanged. Exposed as self.manifest.
+		"""
 		super(CamvidSegmentation, self).__init__()
 		self.data_dir = root
 		self.split = image_set
@@ -54,22 +62,32 @@ class CamvidSegmentation(data.Dataset):
 		self.iamge_dir = os.path.join(self.data_dir, self.split)
 		self.label_dir = os.path.join(self.data_dir, '{}annot'.format(self.split))
 
+		self.manifest = None
+		if manifest_dir is not None:
+			self.manifest = load_or_build(manifest_dir, 'camvid_{}'.format(self.split),
+										  file_stamp(self.data_list_file), self._list_files)
+			self.image_lists, self.label_lists = self.manifest.images, self.manifest.targets
+		else:
+			self.image_lists, self.label_lists = self._list_files()
+		self.image_ids = [os.path.basename(path)[:-len('.png')] for path in self.image_lists]
+
+		assert (len(self.image_lists) == len(self.label_lists))
+
+		# print the dataset info
+		print('Number of image_lists in {}: {:d}'.format(self.split, len(self.image_lists)))
+
+	def _list_files(self):
 		# read file list
 		with open(self.data_list_file, "r") as f:
 			lines = f.read().splitlines()
 			lines = [line.strip().split(' ')[0] for line in lines]
 
 		# extract the id_now
-		self.image_ids = [id_now.split('/')[-1] for id_now in lines]
+		image_ids = [id_now.split('/')[-1] for id_now in lines]
 		# the file list, all are *.png files
-		self.image_lists = [os.path.join(self.iamge_dir, filename) + '.png' for filename in self.image_ids]
-		self.label_lists = [os.path.join(self.label_dir, filename) + '.png' for filename in self.image_ids]
-
-		assert (len(self.image_lists) == len(self.label_lists))
-
-		# print the dataset info
-		print('Number of image_lists in {}: {:d}'.format(self.split, len(self.image_lists)))
-
+		image_lists = [os.path.join(self.iamge_dir, filename) + '.png' for filename in image_ids]
+		label_lists = [os.path.join(self.label_dir, filename) + '.png' for filename in image_ids]
+		return image_lists, label_lists
 
 	def __len__(self):
 		"""len() method"""
@@ -88,6 +106,8 @@ class CamvidSegmentation(data.Dataset):
 		if self.transform is not None:
 			if self.split == 'train' or self.split == 'trainval':
 				img, target, overlaps = self.transform(img, target)
+				if torch.is_tensor(overlaps):  # canvas size, views are built on device by BatchPairedAugment
+					return img, target, overlaps
 				overlap, flip = overlaps
 				return img, target, overlap, flip
 			else:
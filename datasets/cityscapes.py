@@ -7,6 +7,8 @@ import torch.utils.data as data
 from PIL import Image
 import numpy as np
 
+from .manifest import load_or_build, file_stamp
+
 
 class Cityscapes(data.Dataset):
     """Cityscapes <http://www.cityscapes-dataset.com/> Dataset.
@@ -16,7 +18,17 @@ class Cityscapes(data.Dataset):
         - **split** (string, optional): The image split to use, 'train', 'test' or 'val' if mode="gtFine" otherwise 'train', 'train_extra' or 'val'
         - **mode** (string, optional): The quality mode to use, 'gtFine' or 'gtCoarse' or 'color'. Can also be a list to output a tuple with all specified target types.
         - **transform** (callable, optional): A function/transform that takes in a PIL image and returns a transformed version. E.g, ``transforms.RandomCrop``
+          For ``split='train'`` this is the paired transform of ``utils.corr_ts`` and samples are
+          returned as ``(views, targets, overlaps, flip)`` like ``VOCSegmentation``.
+        - **num_copys** (int, optional): Number of views drawn per training sample.
         - **target_transform** (callable, optional): A function/transform that takes in the target and transforms it.
+        - **train_ids** (string, optional): 'png' or 'npy' to load the train-id masks written by
+          ``python -m datasets.cityscapes_labels`` and skip ``encode_target``. Padding transforms in
+          ``transform`` must then fill labels with 255, e.g. ``New_ExtRandomCrop(..., label_fill=255)``,
+          as 0 is class 0 (road) instead of ignore.
+        - **manifest_dir** (string, optional): Directory for a cached manifest of this split
+          (``datasets.manifest``), replacing the directory walk while the city directories are
+          unchanged. The recorded image sizes are exposed as ``self.manifest``.
     """
 
     # Based on https://github.com/mcordts/cityscapesScripts
@@ -70,14 +82,19 @@ class Cityscapes(data.Dataset):
     #train_id_to_color = np.array(train_id_to_color)
     #id_to_train_id = np.array([c.category_id for c in classes], dtype='uint8') - 1
 
-    def __init__(self, root, split='train', mode='fine', target_type='semantic', transform=None):
+    def __init__(self, root, split='train', mode='fine', target_type='semantic', transform=None, num_copys=1, train_ids=None,
+                 manifest_dir=None):
         self.root = os.path.expanduser(root)
         self.mode = 'gtFine'
         self.target_type = target_type
+        self.train_ids = train_ids
+        if train_ids not in (None, 'png', 'npy'):
+            raise ValueError('train_ids should be None, "png" or "npy"')
         self.images_dir = os.path.join(self.root, 'leftImg8bit', split)
 
         self.targets_dir = os.path.join(self.root, self.mode, split)
         self.transform = transform
+        self.num_copys = num_copys
 
         self.split = split
         self.images = []
@@ -90,21 +107,42 @@ class Cityscapes(data.Dataset):
         if not os.path.isdir(self.images_dir) or not os.path.isdir(self.targets_dir):
             raise RuntimeError('Dataset not found or incomplete. Please make sure all required folders for the'
                                ' specified "split" and "mode" are inside the "root" directory')
-        
+
+        self.manifest = None
+        if manifest_dir is not None:
+            name = 'cityscapes_%s_%s' % (split, self._get_target_suffix(self.mode, self.target_type).replace('.', '_'))
+            cities = sorted(os.path.join(self.images_dir, city) for city in os.listdir(self.images_dir))
+            stamp = file_stamp(self.images_dir, self.targets_dir, *cities)
+            self.manifest = load_or_build(manifest_dir, name, stamp, self._list_files)
+            self.images, self.targets = self.manifest.images, self.manifest.targets
+        else:
+            self.images, self.targets = self._list_files()
+
+    def _list_files(self):
+        images, targets = [], []
         for city in os.listdir(self.images_dir):
             img_dir = os.path.join(self.images_dir, city)
             target_dir = os.path.join(self.targets_dir, city)
 
             for file_name in os.listdir(img_dir):
-                self.images.append(os.path.join(img_dir, file_name))
+                images.append(os.path.join(img_dir, file_name))
                 target_name = '{}_{}'.format(file_name.split('_leftImg8bit')[0],
                                              self._get_target_suffix(self.mode, self.target_type))
-                self.targets.append(os.path.join(target_dir, target_name))
+                targets.append(os.path.join(target_dir, target_name))
+        return images, targets
 
     @classmethod
     def encode_target(cls, target):
         return cls.id_to_train_id[np.array(target)]
 
+    @classmethod
+    def encode_views(cls, target):
+        """``encode_target`` for the label tensors of the paired train transform, one tensor or a list of views"""
+        table = torch.from_numpy(cls.id_to_train_id.astype(np.uint8))  # license plate (-1) wraps to 255
+        if torch.is_tensor(target):
+            return table[target.long()]
+        return [table[t.long()] for t in target]
+
     @classmethod
     def decode_target(cls, target):
         target[target == 255] = 19
@@ -120,10 +158,22 @@ class Cityscapes(data.Dataset):
             than one item. Otherwise target is a json object if target_type="polygon", else the image segmentation.
         """
         image = Image.open(self.images[index]).convert('RGB')
-        target = Image.open(self.targets[index])
+        if self.train_ids == 'npy':
+            target = Image.fromarray(np.load(self.targets[index], mmap_mode='r'))
+        else:
+            target = Image.open(self.targets[index])
+        if self.transform and self.split == 'train':
+            image, target, overlaps = self.transform(image, target)
+            if torch.is_tensor(overlaps):  # canvas size, views are built and encoded on device by BatchPairedAugment
+                return image, target, overlaps
+            if self.train_ids is None:
+                target = self.encode_views(target)
+            overlap, flip = overlaps
+            return image, target, overlap, flip
         if self.transform:
             image, target = self.transform(image, target)
-        target = self.encode_target(target)
+        if self.train_ids is None:
+            target = self.encode_target(target)
         return image, target
 
     def __len__(self):
@@ -135,6 +185,8 @@ class Cityscapes(data.Dataset):
         return data
 
     def _get_target_suffix(self, mode, target_type):
+        if target_type == 'semantic' and self.train_ids is not None:
+            return '{}_labelTrainIds.{}'.format(mode, self.train_ids)
         if target_type == 'instance':
             return '{}_instanceIds.png'.format(mode)
         elif target_type == 'semantic':
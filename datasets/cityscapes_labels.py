@@ -0,0 +1,78 @@
+"""Offline conversion of Cityscapes ``labelIds`` masks to train ids.
+
+``Cityscapes.encode_target`` remaps every full-resolution mask through
+``id_to_train_id`` on each access. This tool does that remap once and stores
+``<stem>_gtFine_labelTrainIds.png`` (uint8 PNG) or ``.npy`` (raw uint8, read
+back as a memmap) next to each ``labelIds`` mask. Cities are processed in
+parallel::
+
+    python -m datasets.cityscapes_labels --data_root /path/to/cityscapes \\
+        --splits train val --format png --workers 8
+
+Then build the dataset with ``Cityscapes(..., train_ids='png')``.
+"""
+import os
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+from .cityscapes import Cityscapes
+
+LABEL_IDS_SUFFIX = '_labelIds.png'
+TRAIN_IDS_SUFFIX = {'png': '_labelTrainIds.png', 'npy': '_labelTrainIds.npy'}
+
+
+def encode_file(src, dst):
+    """Remap one ``labelIds`` mask to train ids and write it to ``dst`` (.png or .npy)."""
+    target = Cityscapes.encode_target(Image.open(src)).astype(np.uint8)
+    tmp = dst + '.tmp' + os.path.splitext(dst)[1]
+    if dst.endswith('.npy'):
+        np.save(tmp, target)
+    else:
+        Image.fromarray(target).save(tmp)
+    os.replace(tmp, dst)
+
+
+def encode_city(args):
+    """Convert every mask of one city directory. Returns the number of written files."""
+    city_dir, fmt, overwrite = args
+    written = 0
+    for file_name in sorted(os.listdir(city_dir)):
+        if not file_name.endswith(LABEL_IDS_SUFFIX):
+            continue
+        dst = os.path.join(city_dir, file_name[:-len(LABEL_IDS_SUFFIX)] + TRAIN_IDS_SUFFIX[fmt])
+        if not overwrite and os.path.exists(dst):
+            continue
+        encode_file(os.path.join(city_dir, file_name), dst)
+        written += 1
+    return written
+
+
+def preprocess(root, splits=('train', 'val'), fmt='png', workers=8, overwrite=False, mode='gtFine'):
+    """Materialize train-id masks for all cities of ``splits`` with ``workers`` processes."""
+    tasks = []
+    for split in splits:
+        split_dir = os.path.join(os.path.expanduser(root), mode, split)
+        for city in sorted(os.listdir(split_dir)):
+            tasks.append((os.path.join(split_dir, city), fmt, overwrite))
+    with Pool(workers) as pool:
+        return sum(pool.imap_unordered(encode_city, tasks))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute Cityscapes train-id masks')
+    parser.add_argument('--data_root', type=str, required=True)
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'val'])
+    parser.add_argument('--format', type=str, default='png', choices=['png', 'npy'])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--overwrite', action='store_true', default=False)
+    opts = parser.parse_args()
+
+    n = preprocess(opts.data_root, opts.splits, opts.format, opts.workers, opts.overwrite)
+    print('Wrote %d train-id masks' % n)
+
+
+if __name__ == '__main__':
+    main()
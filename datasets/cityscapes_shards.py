@@ -0,0 +1,213 @@
+"""Sequential tar-shard streaming for Cityscapes.
+
+``write_shards`` packs every ``leftImg8bit`` image together with its
+``gtFine_labelIds`` mask into a few large tar files (raw PNG bytes, no
+re-encoding). ``CityscapesShards`` then streams those tars front to back, so
+reading a sample is one large sequential read instead of two random opens
+on the network filesystem.
+
+Write the train split with::
+
+    python -m datasets.cityscapes_shards --data_root /path/to/cityscapes \\
+        --split train --out_dir shards/cityscapes_train
+"""
+import io
+import os
+import json
+import itertools
+import random
+import tarfile
+import argparse
+
+import torch
+import torch.distributed as dist
+import torch.utils.data as data
+from PIL import Image
+
+from .cityscapes import Cityscapes
+
+IMAGE_KEY = 'leftImg8bit.png'
+TARGET_KEY = 'gtFine_labelIds.png'
+INDEX_FILE = 'shards.json'
+
+
+def write_shards(images, targets, out_dir, prefix='cityscapes', samples_per_shard=256, seed=0):
+    """Write (image, target) pairs into tar shards.
+
+    Samples are shuffled once before writing so that every shard mixes
+    several cities; the streaming reader only has to shuffle locally.
+
+    Args:
+        images (list of str): Paths of the ``*_leftImg8bit.png`` images.
+        targets (list of str): Paths of the matching ``*_gtFine_labelIds.png`` masks.
+        out_dir (str): Output directory, created if missing.
+        prefix (str): File name prefix of the shards.
+        samples_per_shard (int): Number of pairs written to each tar.
+        seed (int): Seed of the write-time shuffle.
+    """
+    assert len(images) == len(targets)
+    os.makedirs(out_dir, exist_ok=True)
+    order = list(range(len(images)))
+    random.Random(seed).shuffle(order)
+
+    shards = []
+    for start in range(0, len(order), samples_per_shard):
+        name = '%s-%05d.tar' % (prefix, len(shards))
+        chunk = order[start:start + samples_per_shard]
+        with tarfile.open(os.path.join(out_dir, name), 'w') as tar:
+            for i in chunk:
+                stem = os.path.basename(images[i]).split('_leftImg8bit')[0]
+                tar.add(images[i], arcname='%s.%s' % (stem, IMAGE_KEY))
+                tar.add(targets[i], arcname='%s.%s' % (stem, TARGET_KEY))
+        shards.append({'name': name, 'samples': len(chunk)})
+
+    with open(os.path.join(out_dir, INDEX_FILE), 'w') as f:
+        json.dump({'shards': shards}, f)
+
+
+class CityscapesShards(data.IterableDataset):
+    """Cityscapes streamed from tar shards written by ``write_shards``.
+
+    Each (rank, DataLoader worker) pair reads a disjoint subset of the
+    shards. Shard order is reshuffled every epoch and samples go through a
+    shuffle buffer that spans shard boundaries. Samples are returned exactly
+    like ``Cityscapes.__getitem__`` for the train split: the paired transform
+    first, then ``encode_views``.
+
+    Every (rank, worker) pair yields the same number of samples, the sample
+    count of the ``len(shards) // (world_size * num_workers)`` smallest
+    shards, so all ranks run the same number of steps under DDP. Shards left
+    over by that split are skipped for the epoch and rotate with the shuffle.
+
+    **Parameters:**
+        - **root** (string): Directory containing the shards and ``shards.json``.
+        - **transform** (callable, optional): The paired train transform (``utils.corr_ts.ExtCompose``), returning views and overlaps.
+        - **shuffle** (bool, optional): Shuffle shard order and samples. Default: True.
+        - **shuffle_buffer** (int, optional): Number of samples held in the shuffle buffer.
+        - **seed** (int, optional): Base seed, combined with the epoch set by ``set_epoch``.
+
+    Use at least ``world_size * num_workers`` shards. ``set_epoch`` only
+    reaches the workers when they are re-created each epoch, i.e. without
+    ``persistent_workers``. ``set_loader_workers`` tells ``__len__`` how many
+    DataLoader workers share a rank.
+    """
+
+    def __init__(self, root, transform=None, shuffle=True, shuffle_buffer=512, seed=0):
+        self.root = os.path.expanduser(root)
+        with open(os.path.join(self.root, INDEX_FILE), 'r') as f:
+            index = json.load(f)
+        self.shards = [os.path.join(self.root, s['name']) for s in index['shards']]
+        self.shard_samples = sorted(s['samples'] for s in index['shards'])
+        self.num_samples = sum(self.shard_samples)
+        self.transform = transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.loader_workers = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_loader_workers(self, num_workers):
+        self.loader_workers = num_workers
+
+    @staticmethod
+    def _rank_and_world():
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    def _quota(self, num_parts):
+        """Samples yielded by each of ``num_parts`` (rank, worker) pairs."""
+        per_part = len(self.shards) // num_parts
+        if per_part == 0:
+            raise ValueError('%d shards cannot feed %d (rank, worker) pairs, write smaller shards'
+                             % (len(self.shards), num_parts))
+        # any part holds at least the per_part smallest shards, whatever the permutation
+        return sum(self.shard_samples[:per_part])
+
+    def _local_shards(self):
+        rank, world_size = self._rank_and_world()
+        worker = data.get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        num_parts = world_size * num_workers
+
+        shards = list(self.shards)
+        if self.shuffle:
+            # same permutation on every rank and worker, so the split stays disjoint
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        shards = shards[:len(shards) // num_parts * num_parts]
+        part = rank * num_workers + worker_id
+        return shards[part::num_parts], part, self._quota(num_parts)
+
+    def _read_pairs(self, shards):
+        for path in shards:
+            # 'r|' streams the archive strictly front to back
+            with tarfile.open(path, 'r|') as tar:
+                pending = {}
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    stem, key = member.name.split('.', 1)
+                    sample = pending.setdefault(stem, {})
+                    sample[key] = tar.extractfile(member).read()
+                    if len(sample) == 2:
+                        yield pending.pop(stem)
+
+    def _decode(self, sample):
+        image = Image.open(io.BytesIO(sample[IMAGE_KEY])).convert('RGB')
+        target = Image.open(io.BytesIO(sample[TARGET_KEY]))
+        if not self.transform:
+            return image, Cityscapes.encode_target(target)
+        image, target, overlaps = self.transform(image, target)
+        if torch.is_tensor(overlaps):  # canvas size, views are built and encoded on device by BatchPairedAugment
+            return image, target, overlaps
+        target = Cityscapes.encode_views(target)
+        overlap, flip = overlaps
+        return image, target, overlap, flip
+
+    def __iter__(self):
+        shards, part, quota = self._local_shards()
+        samples = itertools.islice(self._read_pairs(shards), quota)
+        if not self.shuffle:
+            for sample in samples:
+                yield self._decode(sample)
+            return
+
+        rng = random.Random((self.seed + self.epoch) * 100003 + part)
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            k = rng.randrange(len(buffer))
+            buffer[k], sample = sample, buffer[k]
+            yield self._decode(sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self._decode(sample)
+
+    def __len__(self):
+        _, world_size = self._rank_and_world()
+        num_workers = max(self.loader_workers, 1)
+        return num_workers * self._quota(world_size * num_workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write Cityscapes image/label pairs into tar shards')
+    parser.add_argument('--data_root', type=str, required=True)
+    parser.add_argument('--split', type=str, default='train', choices=['train', 'val', 'test'])
+    parser.add_argument('--out_dir', type=str, required=True)
+    parser.add_argument('--samples_per_shard', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    opts = parser.parse_args()
+
+    dst = Cityscapes(root=opts.data_root, split=opts.split)
+    write_shards(dst.images, dst.targets, opts.out_dir, prefix='cityscapes-%s' % opts.split,
+                 samples_per_shard=opts.samples_per_shard, seed=opts.seed)
+    print('Wrote %d samples to %s' % (len(dst), opts.out_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Cached per-split file lists with image sizes.
+
+Every dataset rebuilds its ``(image, target)`` lists from a split file or a
+directory walk on start and knows nothing about the image dimensions.
+``load_or_build`` stores those lists once in a small JSON manifest together
+with the height, width and file sizes of every sample, and reloads it on the
+next start as long as its stamp still matches.
+
+The stamp is the ``(path, mtime_ns, size)`` of the split file or of the
+split directories, so rewriting a split file or adding a city invalidates the
+manifest. Files edited in place below those directories are not detected;
+delete the manifest after such changes.
+"""
+import os
+import json
+import collections
+
+from PIL import Image
+
+MANIFEST_VERSION = 1
+
+
+def file_stamp(*paths):
+    """``[path, mtime_ns, size]`` of each path, used to detect a stale manifest."""
+    stamp = []
+    for path in paths:
+        st = os.stat(path)
+        stamp.append([os.path.abspath(path), st.st_mtime_ns, st.st_size])
+    return stamp
+
+
+class DatasetManifest(object):
+    """File lists of one dataset split together with the recorded sample sizes.
+
+    Args:
+        images (list of str): Paths of the input images.
+        targets (list of str): Paths of the label masks, aligned with ``images``.
+        heights (list of int): Image heights.
+        widths (list of int): Image widths.
+        image_bytes (list of int): File sizes of the images.
+        target_bytes (list of int): File sizes of the label masks.
+    """
+
+    def __init__(self, images, targets, heights, widths, image_bytes, target_bytes):
+        assert len(images) == len(targets) == len(heights) == len(widths)
+        self.images = images
+        self.targets = targets
+        self.heights = heights
+        self.widths = widths
+        self.image_bytes = image_bytes
+        self.target_bytes = target_bytes
+
+    def __len__(self):
+        return len(self.images)
+
+    @classmethod
+    def build(cls, images, targets):
+        """Read the size of every image; ``Image.open`` only parses the header."""
+        heights, widths, image_bytes, target_bytes = [], [], [], []
+        for image, target in zip(images, targets):
+            with Image.open(image) as img:
+                w, h = img.size
+            heights.append(h)
+            widths.append(w)
+            image_bytes.append(os.path.getsize(image))
+            target_bytes.append(os.path.getsize(target))
+        return cls(list(images), list(targets), heights, widths, image_bytes, target_bytes)
+
+    def save(self, path, stamp):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        state = {'version': MANIFEST_VERSION, 'stamp': stamp, 'images': self.images,
+                 'targets': self.targets, 'heights': self.heights, 'widths': self.widths,
+                 'image_bytes': self.image_bytes, 'target_bytes': self.target_bytes}
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, stamp):
+        """Return the manifest stored at ``path``, or None if it is missing or stale."""
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r') as f:
+            state = json.load(f)
+        if state.get('version') != MANIFEST_VERSION or state.get('stamp') != stamp:
+            return None
+        return cls(state['images'], state['targets'], state['heights'], state['widths'],
+                   state['image_bytes'], state['target_bytes'])
+
+    def shapes(self):
+        return list(zip(self.heights, self.widths))
+
+    def group_by_shape(self):
+        """Map every ``(height, width)`` to the indices of the samples with that shape."""
+        groups = collections.OrderedDict()
+        for i, shape in enumerate(self.shapes()):
+            groups.setdefault(shape, []).append(i)
+        return groups
+
+
+def load_or_build(manifest_dir, name, stamp, list_files):
+    """Load ``<manifest_dir>/<name>.json`` or rebuild it.
+
+    Args:
+        manifest_dir (str): Directory holding the manifests.
+        name (str): Manifest name, unique per dataset split.
+        stamp (list): Validity stamp, usually from ``file_stamp``.
+        list_files (callable): Returns ``(images, targets)``; only called on a miss.
+    """
+    path = os.path.join(os.path.expanduser(manifest_dir), name + '.json')
+    manifest = DatasetManifest.load(path, stamp)
+    if manifest is None:
+        images, targets = list_files()
+        manifest = DatasetManifest.build(images, targets)
+        manifest.save(path, stamp)
+    return manifest
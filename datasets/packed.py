@@ -0,0 +1,153 @@
+"""Pre-decoded, memory-mapped sample store.
+
+``pack_samples`` decodes every (image, mask) pair once and appends the raw
+uint8 pixels to a handful of shard files. ``PackedSampleStore`` memory-maps
+those shards and hands back numpy views, so ``__getitem__`` only slices
+arrays instead of decoding a JPEG and a PNG per sample.
+
+Layout of a packed directory::
+
+    images_000.bin, images_001.bin, ...   # HxWx3 uint8, back to back
+    masks_000.bin,  masks_001.bin,  ...   # HxW uint8, back to back
+    index.npz                             # names, shard, offsets, height, width
+
+Pack the VOC train split with::
+
+    python -m datasets.packed --data_root /path/to/VOC --year 2012_aug \\
+        --image_set train --out_dir packed/voc_2012_aug_train
+"""
+import os
+import argparse
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+INDEX_FILE = 'index.npz'
+IMAGE_SHARD = 'images_%03d.bin'
+MASK_SHARD = 'masks_%03d.bin'
+
+
+def pack_samples(images, masks, out_dir, samples_per_shard=1000):
+    """Decode ``images``/``masks`` once and write them as raw uint8 shards.
+
+    Args:
+        images (list of str): Paths of the RGB images.
+        masks (list of str): Paths of the label masks, aligned with ``images``.
+        out_dir (str): Output directory, created if missing.
+        samples_per_shard (int): Number of samples written to each shard file.
+    """
+    assert len(images) == len(masks)
+    os.makedirs(out_dir, exist_ok=True)
+    n = len(images)
+    names = []
+    shard = np.zeros(n, dtype=np.int32)
+    image_offset = np.zeros(n, dtype=np.int64)
+    mask_offset = np.zeros(n, dtype=np.int64)
+    height = np.zeros(n, dtype=np.int32)
+    width = np.zeros(n, dtype=np.int32)
+
+    img_f = mask_f = None
+    for i in tqdm(range(n)):
+        k = i // samples_per_shard
+        if i % samples_per_shard == 0:
+            if img_f is not None:
+                img_f.close()
+                mask_f.close()
+            img_f = open(os.path.join(out_dir, IMAGE_SHARD % k), 'wb')
+            mask_f = open(os.path.join(out_dir, MASK_SHARD % k), 'wb')
+        img = np.asarray(Image.open(images[i]).convert('RGB'), dtype=np.uint8)
+        mask = np.asarray(Image.open(masks[i]), dtype=np.uint8)
+        if img.shape[:2] != mask.shape:
+            raise RuntimeError('Image and mask sizes differ for %s: %s vs %s'
+                               % (images[i], img.shape[:2], mask.shape))
+        names.append(os.path.splitext(os.path.basename(images[i]))[0])
+        shard[i] = k
+        image_offset[i] = img_f.tell()
+        mask_offset[i] = mask_f.tell()
+        height[i], width[i] = mask.shape
+        img_f.write(np.ascontiguousarray(img).tobytes())
+        mask_f.write(np.ascontiguousarray(mask).tobytes())
+    if img_f is not None:
+        img_f.close()
+        mask_f.close()
+
+    # the index is written last so an interrupted pack is never picked up
+    tmp = os.path.join(out_dir, 'index.tmp.npz')
+    np.savez(tmp, names=np.array(names), shard=shard, image_offset=image_offset,
+             mask_offset=mask_offset, height=height, width=width)
+    os.replace(tmp, os.path.join(out_dir, INDEX_FILE))
+
+
+class PackedSampleStore(object):
+    """Read-only view over a directory written by ``pack_samples``.
+
+    Shards are memory-mapped lazily on first access, so a store can be
+    created in the main process and pickled into DataLoader workers.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.expanduser(root)
+        index_path = os.path.join(self.root, INDEX_FILE)
+        if not os.path.isfile(index_path):
+            raise RuntimeError('Packed index not found at %s. Run `python -m datasets.packed` first.' % index_path)
+        with np.load(index_path) as index:
+            self.names = index['names'].tolist()
+            self.shard = index['shard']
+            self.image_offset = index['image_offset']
+            self.mask_offset = index['mask_offset']
+            self.height = index['height']
+            self.width = index['width']
+        self._images = {}
+        self._masks = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = {}
+        state['_masks'] = {}
+        return state
+
+    def _map(self, cache, pattern, k):
+        mm = cache.get(k)
+        if mm is None:
+            mm = np.memmap(os.path.join(self.root, pattern % k), dtype=np.uint8, mode='r')
+            cache[k] = mm
+        return mm
+
+    def get(self, index):
+        """Return ``(image, mask)`` as HxWx3 and HxW uint8 arrays."""
+        k = int(self.shard[index])
+        h, w = int(self.height[index]), int(self.width[index])
+        i0 = int(self.image_offset[index])
+        m0 = int(self.mask_offset[index])
+        img = self._map(self._images, IMAGE_SHARD, k)[i0:i0 + h * w * 3].reshape(h, w, 3)
+        mask = self._map(self._masks, MASK_SHARD, k)[m0:m0 + h * w].reshape(h, w)
+        return img, mask
+
+    def get_pil(self, index):
+        """Return ``(image, mask)`` as PIL images, matching what the decoders produce."""
+        img, mask = self.get(index)
+        return Image.fromarray(img), Image.fromarray(mask)
+
+
+def main():
+    from datasets.voc import VOCSegmentation
+
+    parser = argparse.ArgumentParser(description='Pack a VOC split into memory-mapped shards')
+    parser.add_argument('--data_root', type=str, required=True)
+    parser.add_argument('--year', type=str, default='2012_aug')
+    parser.add_argument('--image_set', type=str, default='train')
+    parser.add_argument('--out_dir', type=str, required=True)
+    parser.add_argument('--samples_per_shard', type=int, default=1000)
+    opts = parser.parse_args()
+
+    dst = VOCSegmentation(root=opts.data_root, year=opts.year, image_set=opts.image_set)
+    pack_samples(dst.images, dst.masks, opts.out_dir, opts.samples_per_shard)
+    print('Packed %d samples into %s' % (len(dst), opts.out_dir))
+
+
+if __name__ == '__main__':
+    main()
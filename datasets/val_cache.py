@@ -0,0 +1,152 @@
+"""Preprocessed validation samples, built once and reused by every validation.
+
+The validation transforms are deterministic, so ``CachedSamples`` runs the
+wrapped dataset once (in parallel DataLoader workers) and keeps the resulting
+uint8 image and label tensors, either in RAM or in a memory-mapped file that
+survives restarts. Later validations only slice the cache; conversion to
+float and normalization happen on the device in ``prepare_batch``.
+
+The wrapped dataset must return ``(uint8 image [3, H, W], label [H, W])``,
+i.e. end its transform chain with ``ExtToByteTensor``.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+import torch.utils.data as data
+
+from .manifest import file_stamp
+
+INDEX_FILE = 'index.json'
+IMAGES_FILE = 'images.bin'
+LABELS_FILE = 'labels.bin'
+
+
+def _files(dataset):
+    """Image and label paths of the VOC, Cityscapes and CamVid datasets."""
+    for images, labels in (('images', 'masks'), ('images', 'targets'), ('image_lists', 'label_lists')):
+        if hasattr(dataset, images) and hasattr(dataset, labels):
+            return list(getattr(dataset, images)) + list(getattr(dataset, labels))
+    return []
+
+
+def _as_uint8(x):
+    x = x.numpy() if torch.is_tensor(x) else np.asarray(x)
+    if x.dtype != np.uint8:
+        x = x.astype(np.uint8)
+    return np.ascontiguousarray(x)
+
+
+class CachedSamples(data.Dataset):
+    """Cache of a deterministic ``dataset``.
+
+    Args:
+        dataset: Dataset returning uint8 ``(image, label)`` tensors.
+        mode (str): ``'ram'`` keeps the samples in memory, ``'memmap'`` writes them to
+            ``cache_dir`` and maps them, reusing an existing cache whose stamp matches.
+        cache_dir (str, optional): Directory of the memmap cache.
+        num_workers (int): Loader workers used to build the cache.
+        config (dict, optional): JSON-serializable transform settings, e.g. crop size,
+            that change the cached pixels and so must invalidate the cache.
+        indices (sequence, optional): Cache only these samples of ``dataset``, in this
+            order, e.g. the share of one distributed rank. RAM mode only.
+
+    The stamp of the cache holds the dataset type, root and split, ``config``
+    and a digest of the path, mtime and size of every image and label file.
+    """
+
+    def __init__(self, dataset, mode='ram', cache_dir=None, num_workers=8, config=None, indices=None):
+        if mode not in ('ram', 'memmap'):
+            raise ValueError('mode should be "ram" or "memmap"')
+        if mode == 'memmap' and cache_dir is None:
+            raise ValueError('a memmap cache needs cache_dir')
+        if mode == 'memmap' and indices is not None:
+            raise ValueError('a memmap cache holds the whole dataset, indices need mode "ram"')
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.decode_target = getattr(dataset, 'decode_target', None)
+        # anything that changes the cached pixels must change the stamp
+        root = getattr(dataset, 'root', getattr(dataset, 'data_dir', None))
+        split = getattr(dataset, 'image_set', getattr(dataset, 'split', None))
+        files = hashlib.sha1(json.dumps(file_stamp(*_files(dataset))).encode()).hexdigest()
+        self.stamp = {'samples': len(dataset), 'dataset': type(dataset).__name__, 'root': root, 'split': split,
+                      'config': config or {}, 'files': files}
+
+        if mode == 'memmap' and self._load_index():
+            return
+        if indices is not None:
+            dataset = data.Subset(dataset, indices)
+        samples = self._build(dataset, num_workers)
+        if mode == 'ram':
+            self.samples = list(samples)
+        else:
+            self._write(samples)
+            self._load_index()
+
+    def _build(self, dataset, num_workers):
+        """Yields the uint8 samples in order as the loader produces them."""
+        loader = data.DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers)
+        for img, lbl in loader:
+            yield _as_uint8(img), _as_uint8(lbl)
+
+    def _write(self, samples):
+        """Streams ``samples`` to the cache files, holding one sample in memory at a time."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        image_shapes, label_shapes = [], []
+        suffix = '.tmp%d' % os.getpid()
+        with open(os.path.join(self.cache_dir, IMAGES_FILE + suffix), 'wb') as fi, \
+                open(os.path.join(self.cache_dir, LABELS_FILE + suffix), 'wb') as fl:
+            for img, lbl in samples:
+                fi.write(img.tobytes())
+                fl.write(lbl.tobytes())
+                image_shapes.append(list(img.shape))
+                label_shapes.append(list(lbl.shape))
+        for name in (IMAGES_FILE, LABELS_FILE):
+            os.replace(os.path.join(self.cache_dir, name + suffix), os.path.join(self.cache_dir, name))
+        # the index is written last so an interrupted build is rebuilt next time
+        index = {'stamp': self.stamp, 'image_shapes': image_shapes, 'label_shapes': label_shapes}
+        tmp = os.path.join(self.cache_dir, INDEX_FILE + suffix)
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, os.path.join(self.cache_dir, INDEX_FILE))
+
+    def _load_index(self):
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'r') as f:
+            index = json.load(f)
+        if index['stamp'] != self.stamp:
+            return False
+        self.image_shapes = [tuple(s) for s in index['image_shapes']]
+        self.label_shapes = [tuple(s) for s in index['label_shapes']]
+        self.image_offsets = np.cumsum([0] + [int(np.prod(s)) for s in self.image_shapes])
+        self.label_offsets = np.cumsum([0] + [int(np.prod(s)) for s in self.label_shapes])
+        self._images = self._labels = None
+        return True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.mode == 'memmap':
+            state['_images'] = state['_labels'] = None
+        return state
+
+    def __len__(self):
+        if self.mode == 'ram':
+            return len(self.samples)
+        return len(self.image_shapes)
+
+    def __getitem__(self, index):
+        if self.mode == 'ram':
+            img, lbl = self.samples[index]
+            return torch.from_numpy(img), torch.from_numpy(lbl)
+        if self._images is None:
+            self._images = np.memmap(os.path.join(self.cache_dir, IMAGES_FILE), dtype=np.uint8, mode='r')
+            self._labels = np.memmap(os.path.join(self.cache_dir, LABELS_FILE), dtype=np.uint8, mode='r')
+        i0, i1 = self.image_offsets[index], self.image_offsets[index + 1]
+        l0, l1 = self.label_offsets[index], self.label_offsets[index + 1]
+        img = np.array(self._images[i0:i1]).reshape(self.image_shapes[index])
+        lbl = np.array(self._labels[l0:l1]).reshape(self.label_shapes[index])
+        return torch.from_numpy(img), torch.from_numpy(lbl)
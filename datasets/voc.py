@@ -10,6 +10,8 @@ import torch
 from PIL import Image
 from torchvision.datasets.utils import download_url, check_integrity
 from utils import cor_transforms as train_et
+from .packed import PackedSampleStore
+from .manifest import load_or_build, file_stamp
 
 
 
@@ -84,6 +86,15 @@ class VOCSegmentation(data.Dataset):
             downloaded again.
         transform (callable, optional): A function/transform that  takes in an PIL image
             and returns a transformed version. E.g, ``transforms.RandomCrop``
+        packed_dir (string, optional): Directory written by ``python -m datasets.packed``
+            for this split. If given, samples are sliced from its memory-mapped shards
+            instead of being decoded from ``JPEGImages``/``SegmentationClass*``.
+        lazy_decode (bool, optional): Hand the opened but undecoded JPEG to ``transform``
+            instead of converting it to RGB first, so a transform with ``draft=True`` can
+            decode it at reduced size once the scale is known.
+        manifest_dir (string, optional): Directory for a cached manifest of this split
+            (``datasets.manifest``). The file lists and the image sizes are read from it
+            while the split file is unchanged; sizes are exposed as ``self.manifest``.
     """
     cmap = voc_cmap()
     def __init__(self,
@@ -92,7 +103,10 @@ class VOCSegmentation(data.Dataset):
                  image_set='train',
                  download=False,
                  transform=None,
-                 num_copys=1):
+                 num_copys=1,
+                 packed_dir=None,
+                 lazy_decode=False,
+                 manifest_dir=None):
 
         is_aug=False
         if year=='2012_aug':
@@ -106,6 +120,7 @@ class VOCSegmentation(data.Dataset):
         self.md5 = DATASET_YEAR_DICT[year]['md5']
         self.transform = transform
         self.num_copys = num_copys
+        self.lazy_decode = lazy_decode
 
         self.image_set = image_set
         base_dir = DATASET_YEAR_DICT[year]['base_dir']
@@ -139,13 +154,28 @@ class VOCSegmentation(data.Dataset):
                 'Wrong image_set entered! Please use image_set="train" '
                 'or image_set="trainval" or image_set="val"')
 
-        with open(os.path.join(split_f), "r") as f:
-            file_names = [x.strip() for x in f.readlines()]
-        
-        self.images = [os.path.join(image_dir, x + ".jpg") for x in file_names]
-        self.masks = [os.path.join(mask_dir, x + ".png") for x in file_names]
+        def list_files():
+            with open(os.path.join(split_f), "r") as f:
+                file_names = [x.strip() for x in f.readlines()]
+            images = [os.path.join(image_dir, x + ".jpg") for x in file_names]
+            masks = [os.path.join(mask_dir, x + ".png") for x in file_names]
+            return images, masks
+
+        self.manifest = None
+        if manifest_dir is not None:
+            name = 'voc%s%s_%s' % (year, '_aug' if is_aug else '', image_set)
+            self.manifest = load_or_build(manifest_dir, name, file_stamp(split_f, mask_dir), list_files)
+            self.images, self.masks = self.manifest.images, self.manifest.targets
+        else:
+            self.images, self.masks = list_files()
         assert (len(self.images) == len(self.masks))
+        file_names = [os.path.splitext(os.path.basename(x))[0] for x in self.images]
 
+        self.packed = None
+        if packed_dir is not None:
+            self.packed = PackedSampleStore(packed_dir)
+            if self.packed.names != file_names:
+                raise RuntimeError('Packed samples in %s do not match the %s split' % (packed_dir, image_set))
 
 
 
@@ -192,11 +222,18 @@ class VOCSegmentation(data.Dataset):
         Returns:
             tuple: (image, target) where target is the image segmentation.
         """
-        img = Image.open(self.images[index]).convert('RGB')
-        target = Image.open(self.masks[index])
+        if self.packed is not None:
+            img, target = self.packed.get_pil(index)
+        else:
+            img = Image.open(self.images[index])
+            if not self.lazy_decode:
+                img = img.convert('RGB')
+            target = Image.open(self.masks[index])
         if self.transform is not None:
             if self.image_set == 'train':
                 img, target, overlaps = self.transform(img, target)
+                if torch.is_tensor(overlaps):  # canvas size, views are built on device by BatchPairedAugment
+                    return img, target, overlaps
                 overlap, flip = overlaps
                 return img, target, overlap, flip
             else:
@@ -253,6 +290,49 @@ def collate_fn2(batchs):
     return torch.cat(_imgs, dim=0), torch.cat(_targets, dim=0), _overlaps, flips
 
 
+class PairCollate(object):
+    """Tensor-native replacement for ``collate_fn2``.
+
+    Views are copied straight into preallocated batch tensors and the
+    overlaps/flips come back as compact int64 tensors of shape
+    ``[B, num_copys, 2, 2]`` and ``[B]``, so only four tensors cross the
+    worker boundary per batch. Inside a DataLoader worker the batch is
+    allocated in shared memory, as ``default_collate`` does, so sending it to
+    the main process does not copy it again.
+
+    Args:
+        pin_memory (bool): Allocate the batch in pinned memory. Only applies with
+            ``num_workers=0`` and is ignored inside workers; with workers pass
+            ``pin_memory=True`` to the DataLoader instead, which pins in the main process.
+    """
+
+    def __init__(self, pin_memory=False):
+        self.pin_memory = pin_memory
+
+    def empty(self, shape, dtype):
+        if data.get_worker_info() is None:
+            return torch.empty(shape, dtype=dtype, pin_memory=self.pin_memory)
+        elem = torch.empty(0, dtype=dtype)
+        storage = elem._typed_storage() if hasattr(elem, '_typed_storage') else elem.storage()
+        return elem.new(storage._new_shared(int(np.prod(shape)))).view(shape)
+
+    def __call__(self, batchs):
+        imgs, targets, _, _ = batchs[0]
+        num_copys = len(imgs)
+        n = len(batchs) * num_copys
+        images = self.empty((n,) + tuple(imgs[0].shape), imgs[0].dtype)
+        labels = self.empty((n,) + tuple(targets[0].shape), targets[0].dtype)
+        overlaps = self.empty((len(batchs), num_copys, 2, 2), torch.int64)
+        flips = self.empty((len(batchs),), torch.int64)
+        for index, (imgs, targets, overlap, flip) in enumerate(batchs):
+            for i in range(num_copys):
+                images[index * num_copys + i].copy_(imgs[i])
+                labels[index * num_copys + i].copy_(targets[i])
+            overlaps[index] = torch.as_tensor(overlap, dtype=torch.int64)
+            flips[index] = flip
+        return images, labels, overlaps, flips
+
+
 
 
 def main():
@@ -0,0 +1,72 @@
+"""Export a trained DeepLabV3/V3+ checkpoint to TorchScript for inference.
+
+    python export.py --model deeplabv3plus_resnet101 --ckpt checkpoints/best_deeplabv3plus_resnet101_voc_os16.pth \
+        --output deeplabv3plus_resnet101.pt
+
+The exported module is a scripted ``network.TypedSegmentationModel`` in eval
+mode. It takes a normalized float image batch [N, 3, H, W] and returns a list
+of tensors whose last entry is the [N, num_classes, H, W] logits; load it with
+``torch.jit.load`` without this repository.
+"""
+import argparse
+
+import torch
+
+import network
+from benchmark import MODELS
+
+
+def load_model(opts):
+    model = MODELS[opts.model](num_classes=opts.num_classes, output_stride=opts.output_stride,
+                               pretrained_backbone=False)
+    if opts.separable_conv and 'plus' in opts.model:
+        network.convert_to_separable_conv(model.classifier)
+    if opts.ckpt is not None:
+        checkpoint = torch.load(opts.ckpt, map_location='cpu')
+        model.load_state_dict(checkpoint["model_state"])
+        print("Model restored from %s" % opts.ckpt)
+    model.eval()
+    return model
+
+
+def script_model(model, freeze=False):
+    """Script the typed-output variant of an eager ``model``; ``freeze`` folds parameters into the graph."""
+    scripted = torch.jit.script(network.TypedSegmentationModel.from_model(model).eval())
+    return torch.jit.freeze(scripted) if freeze else scripted
+
+
+def max_abs_diff(model, scripted, images):
+    with torch.no_grad():
+        expected = model(images)
+        expected = expected[-1] if isinstance(expected, (list, tuple)) else expected
+        return (scripted(images)[-1] - expected).abs().max().item()
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description='Export a PGC model to TorchScript')
+    parser.add_argument('--model', type=str, default='deeplabv3plus_resnet101', choices=sorted(MODELS))
+    parser.add_argument('--num_classes', type=int, default=21)
+    parser.add_argument('--output_stride', type=int, default=16, choices=[8, 16])
+    parser.add_argument('--separable_conv', action='store_true', default=False,
+                        help='the checkpoint was trained with --separable_conv')
+    parser.add_argument('--ckpt', type=str, default=None, help='checkpoint saved by main.py or main_ds.py')
+    parser.add_argument('--output', type=str, required=True, help='path of the TorchScript file')
+    parser.add_argument('--freeze', action='store_true', default=False, help='torch.jit.freeze the scripted module')
+    parser.add_argument('--check_size', type=int, default=513,
+                        help='compare scripted and eager logits on a random image of this size (0 disables)')
+    return parser
+
+
+def main():
+    opts = get_argparser().parse_args()
+    model = load_model(opts)
+    scripted = script_model(model, opts.freeze)
+    if opts.check_size > 0:
+        images = torch.randn(1, 3, opts.check_size, opts.check_size)
+        print('max |scripted - eager| = %.3g' % max_abs_diff(model, scripted, images))
+    scripted.save(opts.output)
+    print("TorchScript model saved as %s" % opts.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,9 +7,15 @@ import numpy as np
 
 from torch.utils import data
 from datasets import VOCSegmentation, Cityscapes, camvids
+from datasets.cityscapes_shards import CityscapesShards
+from datasets.val_cache import CachedSamples
 from utils import ext_transforms as et
 from utils import corr_ts as train_et
-from metrics import StreamSegMetrics
+from utils import batch_aug
+from utils import loader_tune
+from utils import amp
+from utils.checkpoint import CheckpointWriter
+from metrics import StreamSegMetrics, DeviceAverageMeter
 
 import torch
 import torch.nn as nn
@@ -19,9 +25,16 @@ from utils.visualizer import Visualizer
 from PIL import Image
 import matplotlib
 import matplotlib.pyplot as plt
-from datasets.voc import collate_fn2
+from datasets.voc import collate_fn2, PairCollate
 
-from metrics.losses import ssp_loss, Mixed_Loss, ssp_loss_inner,PGC_loss
+from metrics.losses import PGCTermLoss, build_pgc_terms
+
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got %d' % value)
+    return value
 
 
 def get_argparser():
@@ -92,6 +105,62 @@ def get_argparser():
     parser.add_argument("--year", type=str, default='2012_aug',
                         choices=['2012_aug', '2012', '2011', '2009', '2008', '2007'], help='year of VOC')
     parser.add_argument("--num_copys", type=int, default=2)
+    parser.add_argument("--packed_dir", type=str, default=None,
+                        help="memory-mapped VOC train split written by `python -m datasets.packed` (default: decode files)")
+    parser.add_argument("--cityscapes_shards", type=str, default=None,
+                        help="stream the Cityscapes train split from tar shards written by `python -m datasets.cityscapes_shards`")
+    parser.add_argument("--device_aug", action='store_true', default=False,
+                        help="scale/flip/crop both views as one batched op on the training device (voc, camvids, cityscapes)")
+    parser.add_argument("--fused_crop", action='store_true', default=False,
+                        help="resample only the crop window of each view instead of scaling the whole image (voc, camvids, cityscapes)")
+    parser.add_argument("--tensor_collate", action='store_true', default=False,
+                        help="collate views into preallocated tensors and return overlaps/flips as int tensors")
+    parser.add_argument("--uint8_loader", action='store_true', default=False,
+                        help="loader emits uint8 images/labels; normalization happens on the device")
+    parser.add_argument("--jpeg_draft", action='store_true', default=False,
+                        help="decode VOC train JPEGs at reduced DCT size when the sampled scale is below 1")
+    parser.add_argument("--cityscapes_train_ids", type=str, default=None, choices=['png', 'npy'],
+                        help="load train-id masks written by `python -m datasets.cityscapes_labels` instead of remapping labelIds")
+    parser.add_argument("--manifest_dir", type=str, default=None,
+                        help="cache the file lists and image sizes of each split in this directory")
+    parser.add_argument("--loader_autotune", action='store_true', default=False,
+                        help="benchmark DataLoader worker settings once per host and pipeline and use the fastest")
+    parser.add_argument("--loader_tune_file", type=str, default=None,
+                        help="JSON file with the tuned loader settings (default: ~/.cache/pgc/loader_tune.json)")
+    parser.add_argument("--joint_forward", action='store_true', default=False,
+                        help="run both views through the model in one forward pass")
+    parser.add_argument("--joint_bn", type=str, default='ghost', choices=['ghost', 'shared'],
+                        help="BatchNorm for --joint_forward: 'ghost' keeps per-view statistics as with two forward "
+                             "passes, 'shared' normalizes both views together")
+    parser.add_argument("--amp", type=str, default='off', choices=['off', 'fp16', 'bf16'],
+                        help="mixed precision forward pass; fp16 needs CUDA, bf16 also runs on CPU (default: off)")
+    parser.add_argument("--channels_last", action='store_true', default=False,
+                        help="run the model and its inputs in channels_last (NHWC) memory format")
+    parser.add_argument("--accum_steps", type=int, default=1,
+                        help="split every batch into this many micro-batches of whole view pairs and "
+                             "accumulate their gradients before the optimizer step (default: 1)")
+    parser.add_argument("--checkpoint_layers", type=str, nargs='+', default=None,
+                        help="ResNet stages to recompute in backward, as NAME or NAME:GROUPS, "
+                             "e.g. layer3 layer4:1 (NAME alone checkpoints every Bottleneck)")
+    parser.add_argument("--keep_ckpts", type=positive_int, default=3,
+                        help="number of iteration-stamped checkpoints kept in checkpoints/, at least 1 (default: 3)")
+    parser.add_argument("--pgc_level_crops", type=str, default='batch', choices=['batch', 'pair'],
+                        help="what the feature-level PGC terms compare: 'batch' keeps the original channel/row "
+                             "slices of the whole batch, 'pair' the overlap of each pair (default: batch)")
+    parser.add_argument("--pgc_points", type=int, default=0,
+                        help="compare the views at this many random bilinearly sampled points per overlap "
+                             "instead of over the whole overlap (default: 0, whole overlap)")
+    parser.add_argument("--compile", action='store_true', default=False,
+                        help="train through torch.compile of the typed-output model (validation stays eager)")
+    parser.add_argument("--compile_mode", type=str, default='default',
+                        choices=['default', 'reduce-overhead', 'max-autotune'], help="torch.compile mode")
+    parser.add_argument("--val_cache", type=str, default=None, choices=['ram', 'memmap'],
+                        help="preprocess the val set once and keep it as uint8 in RAM or in a memmap under --val_cache_dir")
+    parser.add_argument("--val_cache_dir", type=str, default='val_cache',
+                        help="directory of the --val_cache memmap files")
+    parser.add_argument("--canvas_size", type=positive_int, default=None,
+                        help="side of the square uint8 canvas the loader pastes samples into for --device_aug "
+                             "(default: 512, 1024x2048 for cityscapes)")
     # Visdom options
     parser.add_argument("--enable_vis", action='store_true', default=False,
                         help="use visdom for visualization")
@@ -105,9 +174,20 @@ def get_argparser():
     return parser
 
 
-def get_dataset(opts):
+def to_tensor(ext_transforms, opts, mean, std, uint8=False):
+    """ Tail of a transform chain: uint8 tensors with --uint8_loader (or ``uint8``), normalized float tensors otherwise
+    """
+    if opts.uint8_loader or uint8:
+        return [ext_transforms.ExtToByteTensor()]
+    return [ext_transforms.ExtToTensor(), ext_transforms.ExtNormalize(mean=mean, std=std)]
+
+
+def get_dataset(opts, rank=0, world_size=1):
     """ Dataset And Augmentation
+
+    With ``world_size > 1`` a RAM --val_cache holds only the samples ``rank::world_size``.
     """
+    cache_val = opts.val_cache is not None
 
     if opts.dataset == 'camvids':
         mean, std = camvids.get_norm()
@@ -117,23 +197,29 @@ def get_dataset(opts):
             train_et.ExtRandomHorizontalFlip(),
             train_et.New_ExtRandomCrop(
                 size=(481, 481), pad_if_needed=True),
-            train_et.ExtToTensor(),
-            train_et.ExtNormalize(mean=mean, std=std),
+            *to_tensor(train_et, opts, mean=mean, std=std),
         ])
         if opts.crop_val:
             val_transform = et.ExtCompose([
                 et.ExtResize(opts.crop_size),
                 et.ExtCenterCrop(opts.crop_size),
-                et.ExtToTensor(),
-                et.ExtNormalize(mean=mean, std=std),
+                *to_tensor(et, opts, mean=mean, std=std, uint8=cache_val),
             ])
         else:
             val_transform = et.ExtCompose([
-                et.ExtToTensor(),
-                et.ExtNormalize(mean=mean, std=std),
+                *to_tensor(et, opts, mean=mean, std=std, uint8=cache_val),
+            ])
+        if opts.fused_crop:
+            train_transform = train_et.ExtCompose([
+                train_et.ExtRandomScaledCrop((0.5, 2.0), size=(481, 481), pad_if_needed=True, num_copys=opts.num_copys),
+                *to_tensor(train_et, opts, mean=mean, std=std),
             ])
-        train_dst = camvids.CamvidSegmentation(opts.data_root, image_set='trainval', transform=train_transform, num_copys=opts.num_copys)
-        val_dst = camvids.CamvidSegmentation(opts.data_root, image_set='test', transform=val_transform)
+        if opts.device_aug:
+            train_transform = batch_aug.ExtToCanvas(get_canvas_size(opts))
+        train_dst = camvids.CamvidSegmentation(opts.data_root, image_set='trainval', transform=train_transform, num_copys=opts.num_copys,
+                                                manifest_dir=opts.manifest_dir)
+        val_dst = camvids.CamvidSegmentation(opts.data_root, image_set='test', transform=val_transform,
+                                              manifest_dir=opts.manifest_dir)
 
     if opts.dataset == 'voc':
         # train_transform = et.ExtCompose([
@@ -147,65 +233,236 @@ def get_dataset(opts):
         # ])
         train_transform = train_et.ExtCompose([
             # et.ExtResize(size=opts.crop_size),
-            train_et.ExtRandomScale((0.5, 2.0)),
+            train_et.ExtRandomScale((0.5, 2.0), draft=opts.jpeg_draft),
             train_et.ExtRandomHorizontalFlip(),
             train_et.New_ExtRandomCrop(
                 size=(opts.crop_size, opts.crop_size), pad_if_needed=True),
-            train_et.ExtToTensor(),
-            train_et.ExtNormalize(mean=[0.485, 0.456, 0.406],
-                                  std=[0.229, 0.224, 0.225]),
+            *to_tensor(train_et, opts, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ])
         if opts.crop_val:
             val_transform = et.ExtCompose([
                 et.ExtResize(opts.crop_size),
                 et.ExtCenterCrop(opts.crop_size),
-                et.ExtToTensor(),
-                et.ExtNormalize(mean=[0.485, 0.456, 0.406],
-                                std=[0.229, 0.224, 0.225]),
+                *to_tensor(et, opts, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], uint8=cache_val),
             ])
         else:
             val_transform = et.ExtCompose([
-                et.ExtToTensor(),
-                et.ExtNormalize(mean=[0.485, 0.456, 0.406],
-                                std=[0.229, 0.224, 0.225]),
+                *to_tensor(et, opts, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], uint8=cache_val),
+            ])
+        if opts.fused_crop:
+            train_transform = train_et.ExtCompose([
+                train_et.ExtRandomScaledCrop((0.5, 2.0), size=(opts.crop_size, opts.crop_size), pad_if_needed=True,
+                                             num_copys=opts.num_copys, draft=opts.jpeg_draft),
+                *to_tensor(train_et, opts, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
             ])
+        if opts.device_aug:
+            train_transform = batch_aug.ExtToCanvas(get_canvas_size(opts))
         train_dst = VOCSegmentation(root=opts.data_root, year=opts.year,
-                                    image_set='train', download=opts.download, transform=train_transform, num_copys=opts.num_copys)
+                                    image_set='train', download=opts.download, transform=train_transform, num_copys=opts.num_copys,
+                                    packed_dir=opts.packed_dir, lazy_decode=opts.jpeg_draft and not opts.device_aug,
+                                    manifest_dir=opts.manifest_dir)
         val_dst = VOCSegmentation(root=opts.data_root, year=opts.year,
-                                  image_set='val', download=False, transform=val_transform)
+                                  image_set='val', download=False, transform=val_transform,
+                                  manifest_dir=opts.manifest_dir)
 
     if opts.dataset == 'cityscapes':
-        train_transform = et.ExtCompose([
+        # raw labelIds are encoded after the crop, so their 0 padding becomes ignore; train ids need it directly
+        label_fill = 255 if opts.cityscapes_train_ids else 0
+        train_transform = train_et.ExtCompose([
             # et.ExtResize( 512 ),
-            et.ExtRandomCrop(size=(opts.crop_size, opts.crop_size)),
-            et.ExtColorJitter(brightness=0.5, contrast=0.5, saturation=0.5),
-            et.ExtRandomHorizontalFlip(),
-            et.ExtToTensor(),
-            et.ExtNormalize(mean=[0.485, 0.456, 0.406],
-                            std=[0.229, 0.224, 0.225]),
+            train_et.ExtRandomScale((0.5, 2.0)),
+            train_et.ExtRandomHorizontalFlip(),
+            train_et.New_ExtRandomCrop(
+                size=(opts.crop_size, opts.crop_size), pad_if_needed=True, label_fill=label_fill),
+            train_et.ExtColorJitter(brightness=0.5, contrast=0.5, saturation=0.5),
+            *to_tensor(train_et, opts, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ])
 
         val_transform = et.ExtCompose([
             # et.ExtResize( 512 ),
-            et.ExtToTensor(),
-            et.ExtNormalize(mean=[0.485, 0.456, 0.406],
-                            std=[0.229, 0.224, 0.225]),
+            *to_tensor(et, opts, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], uint8=cache_val),
         ])
+        if opts.fused_crop:
+            train_transform = train_et.ExtCompose([
+                train_et.ExtRandomScaledCrop((0.5, 2.0), size=(opts.crop_size, opts.crop_size), pad_if_needed=True,
+                                             num_copys=opts.num_copys, label_fill=label_fill),
+                train_et.ExtColorJitter(brightness=0.5, contrast=0.5, saturation=0.5),
+                *to_tensor(train_et, opts, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+            ])
+        if opts.device_aug:
+            train_transform = batch_aug.ExtToCanvas(get_canvas_size(opts))
 
-        train_dst = Cityscapes(root=opts.data_root, split='train', transform=train_transform, num_copys=opts.num_copys)
+        if opts.cityscapes_shards is not None:
+            train_dst = CityscapesShards(opts.cityscapes_shards, transform=train_transform, seed=opts.random_seed)
+        else:
+            train_dst = Cityscapes(root=opts.data_root, split='train', transform=train_transform, num_copys=opts.num_copys,
+                                   train_ids=opts.cityscapes_train_ids, manifest_dir=opts.manifest_dir)
         print("------------------------now copy: {:}----------------------------------".format(opts.num_copys))
         val_dst = Cityscapes(root=opts.data_root,
-                             split='val', transform=val_transform)
+                             split='val', transform=val_transform, train_ids=opts.cityscapes_train_ids,
+                             manifest_dir=opts.manifest_dir)
+
+    if cache_val:
+        cache_dir = os.path.join(opts.val_cache_dir, '%s_val_crop%d' % (opts.dataset, opts.crop_size if opts.crop_val else 0))
+        config = dict(crop_val=opts.crop_val, crop_size=opts.crop_size, train_ids=opts.cityscapes_train_ids)
+        indices = None
+        if opts.val_cache == 'ram' and world_size > 1:
+            indices = range(rank, len(val_dst), world_size)
+        val_dst = CachedSamples(val_dst, mode=opts.val_cache, cache_dir=cache_dir, config=config, indices=indices)
     return train_dst, val_dst
 
 
-def validate(opts, model, loader, device, metrics, ret_samples_ids=None):
+def loader_key(opts, split):
+    """ Identifies a loader pipeline for the tuned settings in --loader_tune_file
+    """
+    flags = [name for name in ('packed_dir', 'cityscapes_shards', 'device_aug', 'fused_crop', 'tensor_collate',
+                               'uint8_loader', 'jpeg_draft', 'cityscapes_train_ids') if getattr(opts, name)]
+    batch_size = opts.batch_size if split == 'train' else opts.val_batch_size
+    crop_size = opts.crop_size if split == 'train' or opts.crop_val else 0
+    canvas_size = get_canvas_size(opts) if split == 'train' and opts.device_aug else (0, 0)
+    return '%s-%s-bs%d-copys%d-crop%d-canvas%dx%d-%s' % (opts.dataset, split, batch_size, opts.num_copys, crop_size,
+                                                         canvas_size[0], canvas_size[1], '+'.join(flags) or 'default')
+
+
+def get_canvas_size(opts):
+    """ (h, w) of the --device_aug canvas: --canvas_size if given, else one that fits every image of the dataset
+    """
+    if opts.dataset == 'cityscapes':
+        if opts.canvas_size is not None and opts.canvas_size < 2048:
+            raise ValueError('--canvas_size must be at least 2048 to hold the 2048x1024 Cityscapes frames')
+        if opts.canvas_size is None:
+            return (1024, 2048)
+    if opts.canvas_size is None:
+        return (512, 512)
+    return (opts.canvas_size, opts.canvas_size)
+
+
+def checkpoint_kwargs(opts):
+    """ --checkpoint_layers as the ``checkpoint_layers`` dict of the ResNet models
+    """
+    if not opts.checkpoint_layers:
+        return {}
+    layers = {}
+    for item in opts.checkpoint_layers:
+        name, _, segments = item.partition(':')
+        layers[name] = int(segments) if segments else None
+    return {'checkpoint_layers': layers}
+
+
+def get_device_aug(opts):
+    """ Batched on-device counterpart of the paired-view train transforms
+    """
+    if opts.dataset == 'camvids':
+        mean, std = camvids.get_norm()
+        return batch_aug.BatchPairedAugment((481, 481), (0.5, 2.0), mean=mean, std=std, num_copys=opts.num_copys)
+    if opts.dataset == 'cityscapes':
+        # the canvas keeps the stored ids; padding is ignore, as labelId 0 is on the PIL path
+        label_map = Cityscapes.id_to_train_id if opts.cityscapes_train_ids is None else None
+        return batch_aug.BatchPairedAugment((opts.crop_size, opts.crop_size), (0.5, 2.0), num_copys=opts.num_copys,
+                                            label_map=label_map, label_fill=255, jitter=(0.5, 0.5, 0.5))
+    return batch_aug.BatchPairedAugment((opts.crop_size, opts.crop_size), (0.5, 2.0), num_copys=opts.num_copys)
+
+
+def get_normalize(opts):
+    """ On-device normalization for batches coming from the loader as uint8
+    """
+    if opts.dataset == 'camvids':
+        mean, std = camvids.get_norm()
+        return utils.DeviceNormalize(mean=mean, std=std)
+    return utils.DeviceNormalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+
+
+def prepare_batch(images, labels, device, normalize, channels_last=False):
+    """ Move a batch to the device; uint8 images are converted and normalized there
+    """
+    images = images.to(device, non_blocking=True)
+    images = normalize(images) if images.dtype == torch.uint8 else images.float()
+    if channels_last:
+        images = images.contiguous(memory_format=torch.channels_last)
+    labels = labels.to(device, dtype=torch.long, non_blocking=True)
+    return images, labels
+
+
+def micro_batches(num_pairs, accum_steps):
+    """ Split ``num_pairs`` view pairs into ``accum_steps`` contiguous (start, stop) ranges
+    """
+    if not 1 <= accum_steps <= num_pairs:
+        raise ValueError('--accum_steps must be between 1 and the number of pairs per batch (%d)' % num_pairs)
+    bounds = np.linspace(0, num_pairs, accum_steps + 1).round().astype(int)
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def forward_pairs(model, images, opts, device):
+    """ Run both views of interleaved ``images`` and pair up the returned pyramid levels
+    """
+    image1, image2 = images[::2], images[1::2]
+    with amp.autocast(opts.amp, device):
+        if opts.joint_forward:
+            # view-major batch, so ghost BN splits it back into the two views
+            return [list(f.chunk(2, dim=0)) for f in model(torch.cat([image1, image2], dim=0))]
+        output1 = model(image1)
+        output2 = model(image2)
+
+    # outputs = {'seg': torch.cat([output1['seg'], output2['seg']]),
+    # 'embedding':[torch.cat((output1['embedding'][0], output2['embedding'][0]), dim=0),
+    #  torch.cat((output1['embedding'][1], output2['embedding'][1]), dim=0)]}
+    outputs = []
+    for f1, f2 in zip(output1, output2):
+        outputs.append([f1, f2])
+    return outputs
+
+
+def build_loaders(opts, train_dst, val_dst, device, train_sampler=None, val_sampler=None, seed=None):
+    """ Train and val DataLoaders, with the worker settings of --loader_autotune / --val_cache
+
+    Returns the loaders and the --device_aug transform (None without it). The
+    RNGs are reseeded with ``seed`` (default --random_seed) after autotuning.
+    """
+    device_aug = None
+    # iterable (streamed) datasets shuffle internally, samplers shuffle themselves
+    shuffle = not isinstance(train_dst, data.IterableDataset) and train_sampler is None
+    if opts.device_aug:
+        train_kwargs = dict(batch_size=opts.batch_size // opts.num_copys, collate_fn=batch_aug.collate_canvas,
+                            shuffle=shuffle, drop_last=True)
+        device_aug = get_device_aug(opts)
+    elif opts.num_copys == 1:
+        train_kwargs = dict(batch_size=opts.batch_size, shuffle=shuffle)
+    else:
+        collate_fn = PairCollate() if opts.tensor_collate else collate_fn2
+        train_kwargs = dict(batch_size=opts.batch_size // opts.num_copys, collate_fn=collate_fn, shuffle=shuffle,
+                            drop_last=True)
+    val_kwargs = dict(batch_size=opts.val_batch_size, shuffle=val_sampler is None)
+    if train_sampler is not None:
+        train_kwargs['sampler'] = train_sampler
+    if val_sampler is not None:
+        val_kwargs['sampler'] = val_sampler
+    # the val cache is already preprocessed, workers would only add IPC
+    train_workers, val_workers = dict(num_workers=2), dict(num_workers=0 if opts.val_cache else 8)
+    if opts.loader_autotune:
+        train_workers = loader_tune.autotune(train_dst, train_kwargs, loader_key(opts, 'train'), opts.loader_tune_file)
+        if not opts.val_cache:
+            val_workers = loader_tune.autotune(val_dst, val_kwargs, loader_key(opts, 'val'), opts.loader_tune_file)
+        # the benchmark consumed random draws of the transforms
+        seed = opts.random_seed if seed is None else seed
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        random.seed(seed)
+    train_workers['pin_memory'] = val_workers['pin_memory'] = device.type == 'cuda'
+    if hasattr(train_dst, 'set_loader_workers'):
+        train_dst.set_loader_workers(train_workers['num_workers'])
+    train_loader = data.DataLoader(train_dst, **train_kwargs, **train_workers)
+    val_loader = data.DataLoader(val_dst, **val_kwargs, **val_workers)
+    return train_loader, val_loader, device_aug
+
+
+def validate(opts, model, loader, device, metrics, ret_samples_ids=None, normalize=None):
     """Do validation and return specified samples"""
+    if normalize is None:
+        normalize = get_normalize(opts)
     metrics.reset()
     ret_samples = []
     if opts.save_val_results:
-        if not os.path.exists('results'):
-            os.mkdir('results')
+        os.makedirs('results', exist_ok=True)
         denorm = utils.Denormalize(mean=[0.485, 0.456, 0.406],
                                    std=[0.229, 0.224, 0.225])
         img_id = 0
@@ -213,10 +470,10 @@ def validate(opts, model, loader, device, metrics, ret_samples_ids=None):
     with torch.no_grad():
         for i, (images, labels) in (enumerate(loader)):
 
-            images = images.to(device, dtype=torch.float32)
-            labels = labels.to(device, dtype=torch.long)
+            images, labels = prepare_batch(images, labels, device, normalize, opts.channels_last)
 
-            outputs = model(images)
+            with amp.autocast(opts.amp, device):
+                outputs = model(images)
             preds = outputs[-1].detach().max(dim=1)[1].cpu().numpy()
             targets = labels.cpu().numpy()
 
@@ -256,6 +513,8 @@ def validate(opts, model, loader, device, metrics, ret_samples_ids=None):
 
 def main():
     opts = get_argparser().parse_args()
+    if opts.compile:
+        network.check_compile()
     if opts.dataset.lower() == 'voc':
         opts.num_classes = 21
     elif opts.dataset.lower() == 'cityscapes':
@@ -285,12 +544,7 @@ def main():
         print('{:16} : {:}'.format(name, value))
 
     train_dst, val_dst = get_dataset(opts)
-    if opts.num_copys == 1:
-        train_loader = data.DataLoader(train_dst, batch_size=opts.batch_size, shuffle=True, num_workers=2)
-    else:
-        train_loader = data.DataLoader(train_dst, batch_size=opts.batch_size // opts.num_copys, collate_fn=collate_fn2, shuffle=True, num_workers=2,
-                                       drop_last=True)
-    val_loader = data.DataLoader(val_dst, batch_size=opts.val_batch_size, shuffle=True, num_workers=8)
+    train_loader, val_loader, device_aug = build_loaders(opts, train_dst, val_dst, device)
     print("Dataset: %s, Train set: %d, Val set: %d" % (opts.dataset, len(train_dst), len(val_dst)))
     model_map = {
         'deeplabv3_resnet50': network.deeplabv3_resnet50,
@@ -301,15 +555,22 @@ def main():
         'deeplabv3plus_mobilenet': network.deeplabv3plus_mobilenet
     }
 
-    model = model_map[opts.model](num_classes=opts.num_classes, output_stride=opts.output_stride)
+    model = model_map[opts.model](num_classes=opts.num_classes, output_stride=opts.output_stride,
+                                  channels_last=opts.channels_last,
+                                  **checkpoint_kwargs(opts))
     if opts.separable_conv and 'plus' in opts.model:
         network.convert_to_separable_conv(model.classifier)
+        if opts.channels_last:  # the separable convs are created in NCHW
+            model.to(memory_format=torch.channels_last)
+    if opts.joint_forward and opts.joint_bn == 'ghost':
+        network.convert_to_ghost_bn(model, num_splits=2)
     utils.set_bn_momentum(model.backbone, momentum=0.01)
     # model = model.to(device)
     # print(model)
 
     # Set up metrics
     metrics = StreamSegMetrics(opts.num_classes)
+    normalize = get_normalize(opts)
 
     # Set up optimizer
     optimizer = torch.optim.SGD(params=[
@@ -334,32 +595,27 @@ def main():
     # Criterion = ssp_loss()
     # Criterion = Mixed_Loss()
 
-    if opts.pgc_mode == 1:
-        use_pgc = [0]
-    elif opts.pgc_mode == 2:
-        use_pgc = [1]
-    elif opts.pgc_mode == 3:
-        use_pgc = [2]
-    else:
-        use_pgc = [0, 1, 2]
-
-    print("pgc mode is:", use_pgc)
+    # only the terms with a nonzero weight are computed
+    Criterion = PGCTermLoss(build_pgc_terms(opts.pgc_mode, opts.alpha, opts.beta), num_points=opts.pgc_points,
+                            level_crops=opts.pgc_level_crops)
+    print("loss terms:", Criterion.terms)
+    scaler = amp.grad_scaler(opts.amp, device)
 
-    Criterion = PGC_loss(use_pgc = use_pgc)
-
-    def save_ckpt(path):
-        """ save current model
+    def save_ckpt(is_best=False):
+        """ queue the current model for the background writer
         """
-        torch.save({
+        name = '%s_%s_os%d' % (opts.model, opts.dataset, opts.output_stride)
+        aliases = ['latest_' + name] + (['best_' + name] if is_best else [])
+        ckpt_writer.save({
             "cur_itrs": cur_itrs,
             "model_state": model.state_dict(),
             "optimizer_state": optimizer.state_dict(),
             "scheduler_state": scheduler.state_dict(),
             "best_score": best_score,
-        }, path)
-        print("Model saved as %s" % path)
+            "scaler_state": scaler.state_dict(),
+        }, 'ckpt_' + name, cur_itrs, aliases)
 
-    utils.mkdir('checkpoints')
+    ckpt_writer = CheckpointWriter('checkpoints', keep=opts.keep_ckpts)
     # Restore
     best_score = 0.0
     cur_itrs = 0
@@ -370,6 +626,8 @@ def main():
         if opts.continue_training:
             optimizer.load_state_dict(checkpoint["optimizer_state"])
             scheduler.load_state_dict(checkpoint["scheduler_state"])
+            if checkpoint.get("scaler_state"):
+                scaler.load_state_dict(checkpoint["scaler_state"])
             cur_itrs = checkpoint["cur_itrs"]
             best_score = checkpoint['best_score']
             print("Training state restored from %s" % opts.ckpt)
@@ -384,6 +642,10 @@ def main():
     #     print("Device is:", Device)
     #     exit(0)
     model.to(device)
+    # the compiled module shares its parameters with ``model``, which is what gets saved
+    train_model = model
+    if opts.compile:
+        train_model = torch.compile(network.TypedSegmentationModel.from_model(model), mode=opts.compile_mode)
 
     # ==========   Train Loop   ==========#
     vis_sample_id = np.random.randint(0, len(val_loader), opts.vis_num_samples,
@@ -394,94 +656,73 @@ def main():
     if opts.test_only:
         model.eval()
         val_score, ret_samples = validate(
-            opts=opts, model=model, loader=val_loader, device=device, metrics=metrics, ret_samples_ids=vis_sample_id)
+            opts=opts, model=model, loader=val_loader, device=device, metrics=metrics, ret_samples_ids=vis_sample_id, normalize=normalize)
         print(metrics.to_str(val_score))
         return
 
-    interval_loss = 0
-    total_mse = 0
-    total_ce = 0
-    total_exce = 0
-    total_sym_ce = 0
-    total_pgc = 0
-    alpha = opts.alpha
-    beta = opts.beta
+    loss_meter = DeviceAverageMeter(['loss'] + Criterion.names)
 
     while cur_itrs < opts.total_itrs:
         print(cur_itrs)
         # =====  Train  =====
         model.train()
         cur_epochs += 1
+        if hasattr(train_dst, 'set_epoch'):
+            train_dst.set_epoch(cur_epochs)
         for sample in train_loader:
-            if opts.num_copys > 1:
+            if opts.device_aug:
+                images, labels, overlap, flips = device_aug(*[t.to(device) for t in sample])
+                overlap, flips = overlap.cpu(), flips.cpu()
+            elif opts.num_copys > 1:
                 images, labels, overlap, flips = sample
             elif opts.num_copys == 1:
                 images, labels = sample
             cur_itrs += 1
 
-            images = images.to(device, dtype=torch.float32)
-            labels = labels.to(device, dtype=torch.long)
+            images, labels = prepare_batch(images, labels, device, normalize, opts.channels_last)
 
             optimizer.zero_grad()
-            image1, image2 = images[::2], images[1::2]
-            
-            output1 = model(image1)
-            output2 = model(image2)
-
-            # outputs = {'seg': torch.cat([output1['seg'], output2['seg']]),
-            # 'embedding':[torch.cat((output1['embedding'][0], output2['embedding'][0]), dim=0),
-            #  torch.cat((output1['embedding'][1], output2['embedding'][1]), dim=0)]}
-            outputs = []
-            for f1, f2 in zip(output1, output2):
-                outputs.append([f1, f2])
-
-            mse, sym_ce, mid_mse, mid_ce, mid_l1, ce = Criterion(outputs, overlap, flips, labels)
-            loss = beta * sym_ce + ce
-            pgc_loss = sum(mid_mse)
-            loss += alpha * pgc_loss
-            #			else:
-            #				with torch.no_grad():
-            #					mse, ce_1_2, ce_2_1, sym_ce = Criterion(outputs, overlap, flips)
-
-            loss.backward()
-            optimizer.step()
-
-            np_loss = loss.detach().cpu().numpy()
-            mse = mse.detach().cpu().numpy().item()
-            sym_ce = sym_ce.detach().cpu().numpy().item()
-            ce = ce.detach().cpu().numpy().item()
-            pgc = pgc_loss.detach().cpu().numpy().item()
-            interval_loss += np_loss
-            total_mse += mse
-            total_sym_ce += sym_ce
-            total_ce += ce
-            total_pgc += pgc
-
-            if cur_itrs % 10 == 0:
-                interval_loss = interval_loss / 10
-                total_mse, total_ce = total_mse / 10, total_ce / 10
-                total_sym_ce /= 10
-
-                print("Epoch %d, Itrs %d/%d, Loss=%f, pgc=%f, mse=%f,  sym_ce=%f, ce=%f" %
-                      (cur_epochs, cur_itrs, opts.total_itrs, interval_loss, total_pgc, total_mse, total_sym_ce, total_ce))
-                interval_loss = 0.0
-                total_mse = 0
-                total_ce = 0
-                total_sym_ce = 0
-                total_pgc = 0
+            num_pairs = images.shape[0] // 2
+            num_valid = (labels != 255).sum().clamp(min=1)
+            terms = dict.fromkeys(loss_meter.names, 0)
+            for start, stop in micro_batches(num_pairs, opts.accum_steps):
+                outputs = forward_pairs(train_model, images[2 * start:2 * stop], opts, device)
+                values = Criterion(outputs, overlap[start:stop], flips[start:stop], labels[2 * start:2 * stop])
+                # PGC terms are means over pairs, ce a mean over labeled pixels:
+                # weight each so the micro-batch losses add up to the full-batch loss
+                pair_w = (stop - start) / num_pairs
+                pixel_w = (labels[2 * start:2 * stop] != 255).sum() / num_valid
+                loss, scaled = Criterion.combine(values, pair_w, pixel_w)
+                #			else:
+                #				with torch.no_grad():
+                #					mse, ce_1_2, ce_2_1, sym_ce = Criterion(outputs, overlap, flips)
+
+                scaler.scale(loss).backward()
+                for name, value in dict(scaled, loss=loss).items():
+                    terms[name] = terms[name] + value.detach()
+            scaler.step(optimizer)
+            scaler.update()
+
+            loss_meter.update(**terms)
+
+            if cur_itrs % opts.print_interval == 0:
+                avg = loss_meter.get_results()
+                print("Epoch %d, Itrs %d/%d, %s" % (cur_epochs, cur_itrs, opts.total_itrs,
+                                                    ', '.join('%s=%f' % item for item in avg.items())))
+                loss_meter.reset()
 
             if cur_itrs % opts.val_interval == 0:
-                save_ckpt('checkpoints/latest_%s_%s_os%d.pth' %
-                          (opts.model, opts.dataset, opts.output_stride))
                 print("validation...")
                 model.eval()
                 val_score, ret_samples = validate(
-                    opts=opts, model=model, loader=val_loader, device=device, metrics=metrics, ret_samples_ids=vis_sample_id)
+                    opts=opts, model=model, loader=val_loader, device=device, metrics=metrics, ret_samples_ids=vis_sample_id, normalize=normalize)
                 print(metrics.to_str(val_score))
-                if val_score['Mean IoU'] > best_score:  # save best model
+                is_best = val_score['Mean IoU'] > best_score
+                if is_best:
                     best_score = val_score['Mean IoU']
-                    save_ckpt('checkpoints/best_%s_%s_os%d.pth' % (opts.model, opts.dataset, opts.output_stride))
-
+                # one snapshot for latest and, on a new best, best
+                save_ckpt(is_best)
+                if is_best:
                     for k, (img, target, lbl) in enumerate(ret_samples):
                         img = (denorm(img) * 255).astype(np.uint8)
                         target = train_dst.decode_target(
@@ -493,6 +734,8 @@ def main():
                 model.train()
             scheduler.step()
 
+    ckpt_writer.close()
+
 
 if __name__ == '__main__':
     main()
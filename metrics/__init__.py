@@ -1,2 +1,2 @@
-from .stream_metrics import StreamSegMetrics, AverageMeter
+from .stream_metrics import StreamSegMetrics, AverageMeter, DeviceAverageMeter
 
@@ -3,8 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.modules.loss as loss
-import numpy as np
-from math import floor
+from torch.autograd.function import once_differentiable
 
 
 class ssp_loss(nn.Module):
@@ -92,23 +91,19 @@ class new_ssp_loss(nn.Module):
         self.ignore_index = ignore_index
 
     def forward(self, outputs, overlap, flips, labels):
-        output1, output2 = outputs
+        # reductions and CE in fp32, also when the model ran under autocast
+        output1, output2 = outputs[0].float(), outputs[1].float()
         N = output1.shape[0]
         mse = 0
         ce_1_2 = 0
         ce_2_1 = 0
-        ex_labels = labels.detach().clone()
 
-        # for i in range(N):
         for i in range(N):
             shape_1 = (overlap[i][0][1][0] - overlap[i][0][0][0], overlap[i][0][1][1] - overlap[i][0][0][1])
             shape_2 = (overlap[i][1][1][0] - overlap[i][1][0][0], overlap[i][1][1][1] - overlap[i][1][0][1])
             img_1 = output1[i, :, overlap[i][0][0][0]:overlap[i][0][1][0], overlap[i][0][0][1]:overlap[i][0][1][1]]
             img_2 = output2[i, :, overlap[i][1][0][0]:overlap[i][1][1][0], overlap[i][1][0][1]:overlap[i][1][1][1]]
 
-            ex_labels[2 * i, overlap[i][0][0][0]:overlap[i][0][1][0], overlap[i][0][0][1]:overlap[i][0][1][1]] = self.ignore_index
-            ex_labels[2 * i + 1, overlap[i][1][0][0]:overlap[i][1][1][0], overlap[i][1][0][1]:overlap[i][1][1][1]] = self.ignore_index
-
             if flips[i] == -1:
                 img_2 = torch.flip(img_2, [2])
 
@@ -133,57 +128,42 @@ class new_ssp_loss(nn.Module):
         sym_ce = 0.5 * (ce_1_2 + ce_2_1)
         label1 = labels[::2]
         label2 = labels[1::2]
-        exlabel1 = ex_labels[::2]
-        exlabel2 = ex_labels[1::2]
         Labels = torch.cat([label1, label2], dim=0).detach()
-        ex_labels = torch.cat([exlabel1, exlabel2], dim=0).detach()
-        Output = torch.cat([outputs[0], outputs[1]], dim=0)
+        Output = torch.cat([output1, output2], dim=0)
         ce = self.ce_loss(Output, Labels)
-        #
-        ex_ce = self.ce_loss(Output, ex_labels)
         return mse, ce_1_2, ce_2_1, sym_ce, ce
 
 
 class ssp_loss_inner(new_ssp_loss):
-    def __init__(self) -> None:
+    """Consistency of one pyramid level.
+
+    The overlap boxes slice ``output[:, y0:y1, x0:x1]``, i.e. channels and rows
+    of the whole batch; ``per_pair=True`` crops the overlap of pair i from
+    ``output[i]`` instead, like new_ssp_loss does on the prediction.
+    """
+
+    def __init__(self, per_pair=False) -> None:
         super(ssp_loss_inner, self).__init__(exclusive=True, ignore_index=255)
+        self.per_pair = per_pair
 
-    def forward(self, outputs, overlap, flips, downsamples=1):
+    def forward(self, outputs, overlap, flips, downsamples=1, boxes=None):
+        outputs = [outputs[0].float(), outputs[1].float()]
         len_img = outputs[0].shape[0]
         mse = 0
         l1 = 0
         ce_1_2 = 0
         ce_2_1 = 0
 
-        # overlap_new = overlap.copy()
-        overlap_new = np.zeros((len_img, 2, 2, 2), dtype=np.int)
-
-
-        if downsamples != 1:
-            for i in range(8):
-                for j in range(2):
-                    if (j == 0):
-                        for k in range(2):
-                            for l in range(2):
-                                overlap_new[i][j][k][l] = floor(overlap[i][j][k][l] / downsamples)
-                        h = overlap_new[i][j][1][0] - overlap_new[i][j][0][0]
-                        w = overlap_new[i][j][1][1] - overlap_new[i][j][0][1]
-                        size = (h, w)
-                 #       print('h:', h, 'w:', w)
-
-                    elif (j == 1):
-                        for k in range(2):
-                            for l in range(2):
-                                if k == 0:
-                                    overlap_new[i][j][k][l] = (overlap[i][j][k][l] // downsamples)
-                                else:
-                                    overlap_new[i][j][k][l] = overlap_new[i][j][0][l] + size[l]
+        if boxes is None:
+            boxes = overlap_pyramid(overlap, [downsamples])[downsamples]
+        overlap_new = boxes.tolist()
 
         for i in range(len_img):
             shape_1 = (overlap_new[i][0][1][0] - overlap_new[i][0][0][0], overlap_new[i][0][1][1] - overlap_new[i][0][0][1])
             shape_2 = (overlap_new[i][1][1][0] - overlap_new[i][1][0][0], overlap_new[i][1][1][1] - overlap_new[i][1][0][1])
-            img_1 = outputs[0][:, overlap_new[i][0][0][0]:overlap_new[i][0][1][0], overlap_new[i][0][0][1]:overlap_new[i][0][1][1]]
-            img_2 = outputs[1][:, overlap_new[i][1][0][0]:overlap_new[i][1][1][0], overlap_new[i][1][0][1]:overlap_new[i][1][1][1]]
+            output1, output2 = (outputs[0][i], outputs[1][i]) if self.per_pair else outputs
+            img_1 = output1[:, overlap_new[i][0][0][0]:overlap_new[i][0][1][0], overlap_new[i][0][0][1]:overlap_new[i][0][1][1]]
+            img_2 = output2[:, overlap_new[i][1][0][0]:overlap_new[i][1][1][0], overlap_new[i][1][0][1]:overlap_new[i][1][1][1]]
 
             if flips[i] == -1:
                 img_2 = torch.flip(img_2, [2])
@@ -217,21 +197,409 @@ class ssp_loss_inner(new_ssp_loss):
 
 
 class PGC_loss(ssp_loss_inner):
-    def __init__(self, exclusive=True, ignore_index=255, use_pgc=[0, 1, 2], down_rate=[16, 16, 4]):
-        super(PGC_loss, self).__init__()
+    def __init__(self, exclusive=True, ignore_index=255, use_pgc=[0, 1, 2], down_rate=[16, 16, 4], per_pair=False):
+        super(PGC_loss, self).__init__(per_pair)
         self.use_pgc = use_pgc
         self.down_rate = dict(zip(use_pgc, down_rate))
 
     def forward(self, outputs, overlap, flips, labels):
         mse, _, _, sym_ce, ce = new_ssp_loss.forward(self, outputs[-1], overlap, flips, labels)
+        pyramid = overlap_pyramid(overlap, [self.down_rate[i] for i in self.use_pgc])
         mid_mse = []
         mid_ce = []
         mid_l1 = []
         for i in self.use_pgc:
             down_rate = self.down_rate[i]
-            mse1, sym_ce1, l11 = ssp_loss_inner.forward(self, outputs[i], overlap, flips, down_rate)
+            mse1, sym_ce1, l11 = ssp_loss_inner.forward(self, outputs[i], overlap, flips, down_rate, pyramid[down_rate])
             mid_mse.append(mse1)
             mid_ce.append(sym_ce1)
             mid_l1.append(l11)
 
         return mse, sym_ce, mid_mse, mid_ce, mid_l1, ce
+
+
+def overlap_pyramid(overlap, down_rates=()):
+    """Overlap boxes of every view at full resolution and at each of ``down_rates``.
+
+    ``overlap`` holds one box ((y0, x0), (y1, x1)) per view for every sample,
+    as nested lists or an int tensor [N, num_copys, 2, 2]. Returns a dict
+    mapping 1 and every down rate to an int64 CPU tensor of that shape. All
+    rates are scaled in one go: the corners of the first view and the origin
+    of the other views are floored, and the other views take the size of
+    the first so the crops of a sample line up.
+    """
+    boxes = torch.as_tensor(overlap, dtype=torch.int64).cpu()
+    pyramid = {1: boxes}
+    rates = sorted(set(down_rates) - {1})
+    if rates:
+        rate = torch.as_tensor(rates, dtype=torch.int64)[:, None, None, None]
+        start = torch.div(boxes[None, :, :, 0], rate, rounding_mode='floor')
+        size = torch.div(boxes[None, :, :1, 1], rate, rounding_mode='floor') - start[:, :, :1]
+        pyramid.update(zip(rates, torch.stack([start, start + size], dim=3).unbind(0)))
+    return pyramid
+
+
+def as_flips(flips):
+    return torch.as_tensor(flips, dtype=torch.int64).cpu().reshape(-1)
+
+
+def gather_overlaps(output1, output2, boxes, flips):
+    """Crop the overlap of every pair with a single gather per view.
+
+    Returns the crops of both views as [N, h, w, C], padded to the largest
+    overlap of the batch, with view 2 mirrored where ``flips == -1``, and the
+    mask [N, h, w] of the positions inside the overlap of non-empty pairs.
+    """
+    N, _, H, W = output1.shape
+    size1 = boxes[:, 0, 1] - boxes[:, 0, 0]
+    size2 = boxes[:, 1, 1] - boxes[:, 1, 0]
+    valid = (size1.min(dim=1)[0] >= 1) & (size2.min(dim=1)[0] >= 1)
+    h, w = (int(size1[:, k].clamp(min=1).max()) for k in range(2))
+    ys, xs = torch.arange(h), torch.arange(w)
+
+    rows1 = boxes[:, 0, 0, 0, None] + ys
+    cols1 = boxes[:, 0, 0, 1, None] + xs
+    rows2 = boxes[:, 1, 0, 0, None] + ys
+    # the flip of view 2 is folded into its column index
+    cols2 = torch.where((flips == -1)[:, None], boxes[:, 1, 1, 1, None] - 1 - xs, boxes[:, 1, 0, 1, None] + xs)
+    mask = ((ys < size1[:, 0, None])[:, :, None] & (xs < size1[:, 1, None])[:, None, :]) & valid[:, None, None]
+
+    device = output1.device
+    n = torch.arange(N, device=device)[:, None, None]
+
+    def crop(output, rows, cols):
+        rows = rows.clamp(0, H - 1).to(device)[:, :, None]
+        cols = cols.clamp(0, W - 1).to(device)[:, None, :]
+        return output[n, :, rows, cols]
+
+    return crop(output1, rows1, cols1), crop(output2, rows2, cols2), mask.to(device), valid.to(device)
+
+
+def gather_batch_overlaps(output1, output2, boxes, flips):
+    """Batched counterpart of the crops of ssp_loss_inner, which slices ``output[:, y0:y1, x0:x1]``.
+
+    Without a pair index the box of pair i selects the channels y0:y1 and the
+    rows x0:x1, over all columns, of every sample of the batch, view 2 with
+    those rows reversed where ``flips == -1``, and the cross entropy between
+    the views runs over the batch dimension. Returns the crops as
+    [N, h, w * W, B] (B, the batch size, in place of the classes), the mask
+    and the valid pairs like gather_overlaps. The boxes must lie inside the
+    channel and row ranges, as the equal-sized slices of the loop need.
+    """
+    B, C, H, W = output1.shape
+    N = boxes.shape[0]
+    size1 = boxes[:, 0, 1] - boxes[:, 0, 0]
+    size2 = boxes[:, 1, 1] - boxes[:, 1, 0]
+    valid = (size1.min(dim=1)[0] >= 1) & (size2.min(dim=1)[0] >= 1)
+    h, w = (int(size1[:, k].clamp(min=1).max()) for k in range(2))
+    ys, xs = torch.arange(h), torch.arange(w)
+
+    rows1 = boxes[:, 0, 0, 0, None] + ys
+    cols1 = boxes[:, 0, 0, 1, None] + xs
+    rows2 = boxes[:, 1, 0, 0, None] + ys
+    cols2 = torch.where((flips == -1)[:, None], boxes[:, 1, 1, 1, None] - 1 - xs, boxes[:, 1, 0, 1, None] + xs)
+    mask = ((ys < size1[:, 0, None])[:, :, None] & (xs < size1[:, 1, None])[:, None, :]) & valid[:, None, None]
+    mask = mask[..., None].expand(N, h, w, W).reshape(N, h, w * W)
+
+    device = output1.device
+
+    def crop(output, rows, cols):
+        rows = rows.clamp(0, C - 1).to(device)[:, :, None]
+        cols = cols.clamp(0, H - 1).to(device)[:, None, :]
+        # [C, H, W, B]: indexing channels and rows gives [N, h, w, W, B]
+        return output.permute(1, 2, 3, 0)[rows, cols].reshape(N, h, w * W, B)
+
+    return crop(output1, rows1, cols1), crop(output2, rows2, cols2), mask.to(device), valid.to(device)
+
+
+CONSISTENCY_KINDS = ('mse', 'sym_ce', 'l1')
+
+
+def _per_pair_weights(mask, valid, dtype, per_position=1):
+    """Weight of every position so that summing gives the mean over each pair's overlap, averaged over the pairs."""
+    count = mask.sum(dim=(1, 2)) * per_position
+    count = torch.where(valid, count, torch.ones_like(count))
+    return mask.to(dtype) / count[:, None, None].to(dtype) / mask.shape[0]
+
+
+class SymmetricConsistency(torch.autograd.Function):
+    """MSE and symmetric argmax cross entropy between two crops in one pass.
+
+    ``forward(logits1, logits2, mask, valid, ignore_index, with_mse, with_ce)``
+    takes the [N, h, w, C] crops of overlap_consistency and returns the scalars
+    ``mse`` and ``sym_ce`` (zero when not requested). Each view gets a single
+    log-softmax; the backward is written out instead of recorded, using
+
+        d mse / d logits1 = 2 * w_mse * (logits1 - logits2) = -d mse / d logits2
+        d ce_1_2 / d logits1 = w_1_2 * (softmax(logits1) - onehot(argmax(logits2)))
+
+    where the ``w`` are the per-position averaging weights, and the argmax
+    targets get no gradient as with CrossEntropyLoss.
+    """
+
+    @staticmethod
+    def forward(ctx, logits1, logits2, mask, valid, ignore_index=255, with_mse=True, with_ce=True):
+        C = logits1.shape[-1]
+        mse = logits1.new_zeros(())
+        sym_ce = logits1.new_zeros(())
+        diff = w_mse = logp1 = logp2 = target1 = target2 = w_1_2 = w_2_1 = None
+        if with_mse:
+            diff = logits1 - logits2
+            w_mse = _per_pair_weights(mask, valid, logits1.dtype, C)
+            mse = (diff.pow(2).sum(dim=-1) * w_mse).sum()
+        if with_ce:
+            logp1 = F.log_softmax(logits1, dim=-1)
+            logp2 = F.log_softmax(logits2, dim=-1)
+            target1, target2 = logp1.argmax(dim=-1), logp2.argmax(dim=-1)
+            # the other view's argmax is ignored where it equals ignore_index, like any label
+            w_1_2 = _per_pair_weights(mask & (target2 != ignore_index), valid, logits1.dtype)
+            w_2_1 = _per_pair_weights(mask & (target1 != ignore_index), valid, logits1.dtype)
+            ce_1_2 = -(logp1.gather(-1, target2.unsqueeze(-1)).squeeze(-1) * w_1_2).sum()
+            ce_2_1 = -(logp2.gather(-1, target1.unsqueeze(-1)).squeeze(-1) * w_2_1).sum()
+            sym_ce = 0.5 * (ce_1_2 + ce_2_1)
+        ctx.save_for_backward(diff, w_mse, logp1, logp2, target1, target2, w_1_2, w_2_1)
+        return mse, sym_ce
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_mse, grad_sym_ce):
+        diff, w_mse, logp1, logp2, target1, target2, w_1_2, w_2_1 = ctx.saved_tensors
+        grad1 = grad2 = None
+        if diff is not None:
+            grad1 = diff * (2 * grad_mse * w_mse).unsqueeze(-1)
+            grad2 = -grad1
+        if logp1 is not None:
+            def ce_grad(logp, target, weight):
+                grad = logp.exp()
+                grad.scatter_add_(-1, target.unsqueeze(-1), grad.new_full(target.shape + (1,), -1.0))
+                return grad * (0.5 * grad_sym_ce * weight).unsqueeze(-1)
+
+            ce_grad1 = ce_grad(logp1, target2, w_1_2)
+            ce_grad2 = ce_grad(logp2, target1, w_2_1)
+            grad1 = ce_grad1 if grad1 is None else grad1 + ce_grad1
+            grad2 = ce_grad2 if grad2 is None else grad2 + ce_grad2
+        return grad1, grad2, None, None, None, None, None
+
+
+def overlap_consistency(output1, output2, boxes, flips, ignore_index=255, kinds=CONSISTENCY_KINDS, fused=True,
+                        batch_crops=False):
+    """Batched counterpart of the per-pair terms of new_ssp_loss, or with ``batch_crops`` of ssp_loss_inner.
+
+    Returns a dict with the requested ``kinds`` among ``mse``, ``sym_ce`` and
+    ``l1``, each averaged over the pairs, with pairs whose overlap is empty
+    contributing zero as in the loops. Kinds that are not requested are not
+    computed. With ``fused`` the mse and the symmetric CE come from
+    SymmetricConsistency instead of separately recorded ops. ``batch_crops``
+    takes the crops of gather_batch_overlaps instead of gather_overlaps.
+    """
+    gather = gather_batch_overlaps if batch_crops else gather_overlaps
+    crop1, crop2, mask, valid = gather(output1, output2, boxes, flips)
+    return crop_consistency(crop1, crop2, mask, valid, ignore_index, kinds, fused)
+
+
+def crop_consistency(crop1, crop2, mask, valid, ignore_index=255, kinds=CONSISTENCY_KINDS, fused=True):
+    """Consistency ``kinds`` of matching [N, h, w, C] crops of the two views, see overlap_consistency."""
+    N, C = crop1.shape[0], crop1.shape[-1]
+    values = {}
+
+    if fused and ('mse' in kinds or 'sym_ce' in kinds):
+        mse, sym_ce = SymmetricConsistency.apply(crop1, crop2, mask, valid, ignore_index,
+                                                 'mse' in kinds, 'sym_ce' in kinds)
+        values.update((k, v) for k, v in (('mse', mse), ('sym_ce', sym_ce)) if k in kinds)
+        if 'l1' not in kinds:
+            return values
+
+    pixels = mask.sum(dim=(1, 2))
+    if 'l1' in kinds or ('mse' in kinds and 'mse' not in values):
+        numel = torch.where(valid, pixels * C, torch.ones_like(pixels)).to(crop1.dtype)
+        diff = (crop1 - crop2) * mask.unsqueeze(-1).to(crop1.dtype)
+        if 'mse' in kinds and 'mse' not in values:
+            values['mse'] = (diff.pow(2).sum(dim=(1, 2, 3)) / numel).sum() / N
+        if 'l1' in kinds:
+            values['l1'] = (diff.abs().sum(dim=(1, 2, 3)) / numel).sum() / N
+
+    if 'sym_ce' in kinds and 'sym_ce' not in values:
+        def ce(logits, target):
+            # CrossEntropyLoss against the other view's argmax, which ignores ``ignore_index`` like any label
+            target = target.detach()
+            keep = mask & (target != ignore_index)
+            nll = -F.log_softmax(logits, dim=-1).gather(-1, target.unsqueeze(-1)).squeeze(-1)
+            count = torch.where(valid, keep.sum(dim=(1, 2)), torch.ones_like(pixels)).to(logits.dtype)
+            return ((nll * keep).sum(dim=(1, 2)) / count).sum() / N
+
+        values['sym_ce'] = 0.5 * (ce(crop1, crop2.argmax(dim=-1)) + ce(crop2, crop1.argmax(dim=-1)))
+    return values
+
+
+def sample_overlap_points(boxes, flips, num_points):
+    """Draw ``num_points`` matching points uniformly inside the full-resolution overlap of every pair.
+
+    Returns the continuous (y, x) coordinates of the points in both views as
+    float tensors [N, K, 2], pixel i covering [i, i + 1), and the mask [N] of
+    the pairs with a non-empty overlap. The flip of view 2 mirrors its x
+    inside the box.
+    """
+    start1, start2 = boxes[:, 0, 0].float(), boxes[:, 1, 0].float()
+    size = (boxes[:, 0, 1] - boxes[:, 0, 0]).float()
+    valid = (size.min(dim=1)[0] >= 1) & ((boxes[:, 1, 1] - boxes[:, 1, 0]).min(dim=1)[0] >= 1)
+    offset = torch.rand(boxes.shape[0], num_points, 2) * size[:, None]
+    points1 = start1[:, None] + offset
+    points2 = start2[:, None] + offset
+    mirrored = boxes[:, 1, 1, 1, None].float() - offset[..., 1]
+    points2[..., 1] = torch.where((flips == -1)[:, None], mirrored, points2[..., 1])
+    return points1, points2, valid
+
+
+def sample_points(output, points, image_size):
+    """Bilinearly sample [N, C, H, W] ``output`` at full-resolution ``points`` [N, K, 2], giving [N, K, C].
+
+    The points are normalized by the full-resolution ``image_size``, so every
+    pyramid level is sampled at the same relative position whatever its
+    stride.
+    """
+    height, width = image_size
+    grid = torch.stack([2 * points[..., 1] / width - 1, 2 * points[..., 0] / height - 1], dim=-1)
+    grid = grid.to(device=output.device, dtype=output.dtype).unsqueeze(2)
+    samples = F.grid_sample(output, grid, mode='bilinear', padding_mode='border', align_corners=False)
+    return samples.squeeze(3).permute(0, 2, 1)
+
+
+class LossTerm(object):
+    """One weighted term of the PGC objective.
+
+    Args:
+        name (str): Name the term is returned and logged under.
+        weight (float): Factor of the term in the loss.
+        kind (str): ``'ce'`` for the supervised cross entropy of the prediction,
+            or a consistency kind of ``overlap_consistency`` (``'mse'``,
+            ``'sym_ce'``, ``'l1'``) between the two views.
+        level (int): Index of the model output the term compares, -1 for the prediction.
+        down_rate (int): Downsampling of that output relative to the overlap boxes.
+    """
+
+    def __init__(self, name, weight, kind, level=-1, down_rate=1):
+        if kind != 'ce' and kind not in CONSISTENCY_KINDS:
+            raise ValueError('Unknown loss term kind %s' % kind)
+        self.name = name
+        self.weight = weight
+        self.kind = kind
+        self.level = level
+        self.down_rate = down_rate
+
+    @property
+    def per_pixel(self):
+        """The supervised CE is a mean over labeled pixels, the consistency terms are means over pairs."""
+        return self.kind == 'ce'
+
+    def __repr__(self):
+        return 'LossTerm(%s=%g*%s, level=%d, down_rate=%d)' % (self.name, self.weight, self.kind, self.level,
+                                                                self.down_rate)
+
+
+def build_pgc_terms(pgc_mode=0, alpha=0.2, beta=0.9, down_rate=[16, 16, 4]):
+    """Terms of ``ce + beta * sym_ce + alpha * sum of the pyramid-level mse`` for ``--pgc_mode``.
+
+    pgc_mode 1, 2 and 3 put the mse on output 0, 1 or 2 alone, any other mode
+    on all three, with the down rates PGC_loss assigns. Terms whose weight is
+    zero are left out.
+    """
+    use_pgc = {1: [0], 2: [1], 3: [2]}.get(pgc_mode, [0, 1, 2])
+    down_rate = dict(zip(use_pgc, down_rate))
+    terms = [LossTerm('ce', 1.0, 'ce')]
+    if beta:
+        terms.append(LossTerm('sym_ce', beta, 'sym_ce'))
+    if alpha:
+        # ssp_loss_inner counted the mse of every pair twice, the weight keeps that scale
+        terms.extend(LossTerm('pgc%d' % i, 2 * alpha, 'mse', level=i, down_rate=down_rate[i]) for i in use_pgc)
+    return terms
+
+
+class PGCTermLoss(nn.Module):
+    """PGC objective made of ``LossTerm``s, computing only the terms it was given.
+
+    ``forward`` returns the unweighted value of every term by name; ``combine``
+    weights them into the loss. Each pyramid level is cropped once for all the
+    kinds requested on it, and the overlap boxes are scaled once per step.
+    Terms on the prediction (level -1) compare the overlap of each pair like
+    new_ssp_loss. With ``level_crops='batch'`` terms on the feature levels
+    take the batch slices of ssp_loss_inner (see gather_batch_overlaps), so
+    the values match PGC_loss; ``'pair'`` crops the overlap of each pair on
+    those levels too, matching ``PGC_loss(per_pair=True)``.
+
+    With ``num_points > 0`` the consistency terms compare the two views only
+    at that many random points per overlap, bilinearly sampled at matching
+    sub-pixel positions of every level, so their cost no longer grows with
+    the overlap area. The points of a pair are compared with each other on
+    every level, and ``down_rate`` is not used.
+    """
+
+    def __init__(self, terms, ignore_index=255, num_points=0, level_crops='batch'):
+        super(PGCTermLoss, self).__init__()
+        if level_crops not in ('batch', 'pair'):
+            raise ValueError('level_crops should be "batch" or "pair", got %s' % level_crops)
+        self.num_points = num_points
+        self.level_crops = level_crops
+        self.terms = list(terms)
+        self.names = [t.name for t in self.terms]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError('Loss term names must be unique')
+        self.ignore_index = ignore_index
+        # summed, then divided by the clamped count: a micro-batch without labeled
+        # pixels gives 0 and no gradient instead of a 0/0 NaN
+        self.ce_loss = nn.CrossEntropyLoss(ignore_index=ignore_index, reduction='sum')
+
+    def forward(self, outputs, overlap, flips, labels):
+        values = {}
+        levels = {}
+        for t in self.terms:
+            if t.kind == 'ce':
+                output = torch.cat([outputs[t.level][0], outputs[t.level][1]], dim=0).float()
+                Labels = torch.cat([labels[::2], labels[1::2]], dim=0).detach()
+                num_labeled = (Labels != self.ignore_index).sum().clamp(min=1)
+                values[t.name] = self.ce_loss(output, Labels) / num_labeled
+            else:
+                levels.setdefault((t.level, t.down_rate), []).append(t)
+        if not levels:
+            return values
+
+        flip = as_flips(flips)
+        if self.num_points > 0:
+            values.update(self.point_terms(outputs, overlap_pyramid(overlap)[1], flip, levels))
+            return values
+
+        pyramid = overlap_pyramid(overlap, [down_rate for _, down_rate in levels])
+        for (level, down_rate), terms in levels.items():
+            consistency = overlap_consistency(outputs[level][0].float(), outputs[level][1].float(),
+                                              pyramid[down_rate], flip, self.ignore_index,
+                                              set(t.kind for t in terms),
+                                              batch_crops=self.level_crops == 'batch' and
+                                              level % len(outputs) != len(outputs) - 1)
+            for t in terms:
+                values[t.name] = consistency[t.kind]
+        return values
+
+    def point_terms(self, outputs, boxes, flips, levels):
+        points1, points2, valid = sample_overlap_points(boxes, flips, self.num_points)
+        image_size = outputs[-1][0].shape[-2:]
+        valid = valid.to(outputs[-1][0].device)
+        mask = valid[:, None, None].expand(-1, self.num_points, 1)
+        values = {}
+        for level in set(level for level, _ in levels):
+            terms = [t for (l, _), level_terms in levels.items() if l == level for t in level_terms]
+            samples1 = sample_points(outputs[level][0].float(), points1, image_size).unsqueeze(2)
+            samples2 = sample_points(outputs[level][1].float(), points2, image_size).unsqueeze(2)
+            consistency = crop_consistency(samples1, samples2, mask, valid, self.ignore_index,
+                                           set(t.kind for t in terms))
+            for t in terms:
+                values[t.name] = consistency[t.kind]
+        return values
+
+    def combine(self, values, pair_weight=1.0, pixel_weight=1.0):
+        """Weighted loss of ``values`` and the per-term values scaled like in the loss, for logging.
+
+        ``pair_weight`` and ``pixel_weight`` rescale the pair-averaged and the
+        pixel-averaged terms, e.g. to add up micro-batches to the batch loss.
+        """
+        scaled = {t.name: (pixel_weight if t.per_pixel else pair_weight) * values[t.name] for t in self.terms}
+        loss = sum(t.weight * scaled[t.name] for t in self.terms)
+        return loss, scaled
@@ -1,4 +1,6 @@
 import numpy as np
+import torch
+import torch.distributed as dist
 from sklearn.metrics import confusion_matrix
 
 class _StreamMetrics(object):
@@ -108,3 +110,35 @@ class AverageMeter(object):
         record = self.book.get(id, None)
         assert record is not None
         return record[0] / record[1]
+
+
+class DeviceAverageMeter(object):
+    """Running averages of scalar loss tensors, accumulated on their device.
+
+    ``update`` only adds to a stacked tensor, so logging costs no host sync per
+    step; ``get_results`` syncs once. With ``all_reduce=True`` the averages are
+    also averaged over the default process group (every rank must call it).
+    """
+    def __init__(self, names):
+        self.names = list(names)
+        self.reset()
+
+    def reset(self):
+        self.sums = None
+        self.count = 0
+
+    def update(self, **vals):
+        ref = next(v for v in vals.values() if torch.is_tensor(v))
+        step = torch.stack([torch.as_tensor(vals[name], device=ref.device).detach().float()
+                            for name in self.names])
+        self.sums = step if self.sums is None else self.sums + step
+        self.count += 1
+
+    def get_results(self, all_reduce=False):
+        if self.sums is None:
+            return dict.fromkeys(self.names, 0.0)
+        avg = self.sums / self.count
+        if all_reduce and dist.is_available() and dist.is_initialized():
+            dist.all_reduce(avg)
+            avg /= dist.get_world_size()
+        return dict(zip(self.names, avg.tolist()))
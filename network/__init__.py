@@ -1,2 +1,3 @@
 from .modeling import *
-from ._deeplab import convert_to_separable_conv
\ No newline at end of file
+from ._deeplab import convert_to_separable_conv
+from .utils import GhostBatchNorm2d, TypedSegmentationModel, check_compile, convert_to_ghost_bn
@@ -1,6 +1,7 @@
 import torch
 from torch import nn
 from torch.nn import functional as F
+from typing import Dict, List
 
 from .utils import _SimpleSegmentationModel
 
@@ -97,9 +98,7 @@ class DeepLabHeadV3Plus(nn.Module):
 
         self._init_weight()
 
-    def forward(self, feature, Siam=False):
-
-
+    def forward(self, feature: Dict[str, torch.Tensor], Siam: bool = False) -> List[torch.Tensor]:
         low_level_feature = self.project(feature['low_level'])
         res_out = feature['out']
         output_feature = self.aspp(feature['out'])
@@ -132,6 +131,7 @@ class DeepLabHead(nn.Module):
             nn.Conv2d(256, num_classes, 1)
         )
 
+        # unused by the forward, kept so existing checkpoints still load
         self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
         self.fc = nn.Linear(in_channels, in_channels)
 
@@ -141,15 +141,7 @@ class DeepLabHead(nn.Module):
 
         self._init_weight()
 
-    def forward(self, feature):
-        x = self.avgpool(feature['out'])
-        x = torch.flatten(x, 1)
-        x = self.fc(x)
-        x = x.view(x.shape[0], -1)
-        z = self.projection(x)
-        p = self.prediction(z)
-        result = {'seg': self.classifier(feature['out']),
-            'embedding': [z, p]}
+    def forward(self, feature: Dict[str, torch.Tensor]) -> torch.Tensor:
         return self.classifier(feature['out'])
 
 
@@ -211,7 +203,8 @@ class ASPPPooling(nn.Sequential):
 
     def forward(self, x):
         size = x.shape[-2:]
-        x = super(ASPPPooling, self).forward(x)
+        for mod in self:
+            x = mod(x)
         return F.interpolate(x, size=size, mode='bilinear', align_corners=False)
 
 
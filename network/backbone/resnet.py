@@ -1,6 +1,9 @@
+import contextlib
+
 import torch
 import torch.nn as nn
-from torchvision.models.utils import load_state_dict_from_url
+from torch.utils.checkpoint import checkpoint
+from torch.hub import load_state_dict_from_url
 
 
 __all__ = ['ResNet', 'resnet18', 'resnet34', 'resnet50', 'resnet101',
@@ -115,11 +118,74 @@ class Bottleneck(nn.Module):
         return out
 
 
+@contextlib.contextmanager
+def _frozen_bn_stats(modules):
+    """Keep the running statistics of every BatchNorm in ``modules`` unchanged."""
+    bns = [m for module in modules for m in module.modules()
+           if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, tracked) in zip(bns, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(tracked)
+
+
+class _CheckpointSegment(object):
+    """Runs a group of blocks for ``checkpoint``; the second call is the backward recompute."""
+    def __init__(self, modules):
+        self.modules = modules
+        self.calls = 0
+
+    def __call__(self, x):
+        self.calls += 1
+        # the recompute must not update the BN running statistics a second time
+        with _frozen_bn_stats(self.modules) if self.calls > 1 else contextlib.nullcontext():
+            for module in self.modules:
+                x = module(x)
+        return x
+
+
+class CheckpointedSequential(nn.Sequential):
+    """nn.Sequential that can recompute its activations in backward instead of storing them.
+
+    With ``segments > 0`` the blocks are split into that many consecutive groups
+    and only the input of each group is kept during training; ``segments`` equal
+    to the number of blocks checkpoints every Bottleneck. The parameter names are
+    those of nn.Sequential, so checkpoints and pretrained weights load unchanged.
+    """
+    def __init__(self, *args, segments=0):
+        super(CheckpointedSequential, self).__init__(*args)
+        self.segments = segments
+
+    def forward(self, x):
+        if self.segments > 0 and self.training and torch.is_grad_enabled():
+            return self._checkpointed_forward(x)
+        for module in self:
+            x = module(x)
+        return x
+
+    @torch.jit.unused
+    def _checkpointed_forward(self, x):
+        modules = list(self)
+        segments = min(self.segments, len(modules))
+        bounds = [round(i * len(modules) / segments) for i in range(segments + 1)]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            x = checkpoint(_CheckpointSegment(modules[start:stop]), x, use_reentrant=False)
+        return x
+
+    def extra_repr(self):
+        return 'segments={}'.format(self.segments) if self.segments else ''
+
+
 class ResNet(nn.Module):
 
     def __init__(self, block, layers, num_classes=1000, zero_init_residual=False,
                  groups=1, width_per_group=64, replace_stride_with_dilation=None,
-                 norm_layer=None):
+                 norm_layer=None, checkpoint_layers=None):
         super(ResNet, self).__init__()
         if norm_layer is None:
             norm_layer = nn.BatchNorm2d
@@ -168,6 +234,24 @@ class ResNet(nn.Module):
                 elif isinstance(m, BasicBlock):
                     nn.init.constant_(m.bn2.weight, 0)
 
+        if checkpoint_layers:
+            self.set_checkpointing(checkpoint_layers)
+
+    def set_checkpointing(self, checkpoint_layers):
+        """Enable activation checkpointing per stage.
+
+        Args:
+            checkpoint_layers (dict): Maps stage names (``'layer1'`` ... ``'layer4'``) to the
+                number of checkpointed groups, None for one group per block, 0 to disable.
+        """
+        for name, segments in checkpoint_layers.items():
+            if name not in ('layer1', 'layer2', 'layer3', 'layer4'):
+                raise ValueError('checkpointing is only supported for layer1..layer4, got %s' % name)
+            if segments is not None and segments < 0:
+                raise ValueError('checkpoint groups of %s must be >= 0, got %d' % (name, segments))
+            layer = getattr(self, name)
+            layer.segments = len(layer) if segments is None else segments
+
     def _make_layer(self, block, planes, blocks, stride=1, dilate=False):
         norm_layer = self._norm_layer
         downsample = None
@@ -190,7 +274,7 @@ class ResNet(nn.Module):
                                 base_width=self.base_width, dilation=self.dilation,
                                 norm_layer=norm_layer))
 
-        return nn.Sequential(*layers)
+        return CheckpointedSequential(*layers)
 
     def forward(self, x):
         x = self.conv1(x)
@@ -1,15 +1,17 @@
+import torch
+
 from .utils import IntermediateLayerGetter
 from ._deeplab import DeepLabHead, DeepLabHeadV3Plus, DeepLabV3
 from .backbone import resnet
 from .backbone import mobilenetv2
-from torchvision.models.utils import load_state_dict_from_url
+from torch.hub import load_state_dict_from_url
 
 model_urls = {
     'deeplabv3_resnet50_coco': None,
     'deeplabv3_resnet101_coco': None,
 }
 
-def _segm_resnet(name, backbone_name, num_classes, output_stride, pretrained_backbone=True):
+def _segm_resnet(name, backbone_name, num_classes, output_stride, pretrained_backbone=True, checkpoint_layers=None):
 
     if output_stride==8:
         replace_stride_with_dilation=[False, True, True]
@@ -20,7 +22,8 @@ def _segm_resnet(name, backbone_name, num_classes, output_stride, pretrained_bac
 
     backbone = resnet.__dict__[backbone_name](
         pretrained=pretrained_backbone,
-        replace_stride_with_dilation=replace_stride_with_dilation)
+        replace_stride_with_dilation=replace_stride_with_dilation,
+        checkpoint_layers=checkpoint_layers)
     
     inplanes = 2048
     low_level_planes = 256
@@ -63,12 +66,17 @@ def _segm_mobilenet(name, backbone_name, num_classes, output_stride, pretrained_
     model = DeepLabV3(backbone, classifier)
     return model
 
-def _load_model(arch_type, backbone, pretrained, progress, num_classes, output_stride=8):
+def _load_model(arch_type, backbone, pretrained, progress, num_classes, output_stride=8,
+                pretrained_backbone=True, channels_last=False, checkpoint_layers=None):
 
     if backbone=='mobilenetv2':
-        model = _segm_mobilenet(arch_type, backbone, num_classes, output_stride=output_stride)
+        if checkpoint_layers:
+            raise ValueError('activation checkpointing is only supported for the ResNet backbones, got %s' % backbone)
+        model = _segm_mobilenet(arch_type, backbone, num_classes, output_stride=output_stride,
+                                pretrained_backbone=pretrained_backbone)
     elif backbone.startswith('resnet'):
-        model = _segm_resnet(arch_type, backbone, num_classes, output_stride=output_stride)
+        model = _segm_resnet(arch_type, backbone, num_classes, output_stride=output_stride,
+                             pretrained_backbone=pretrained_backbone, checkpoint_layers=checkpoint_layers)
     else:
         raise NotImplementedError
 
@@ -80,6 +88,9 @@ def _load_model(arch_type, backbone, pretrained, progress, num_classes, output_s
         else:
             state_dict = load_state_dict_from_url(model_url, progress=progress)
             model.load_state_dict(state_dict)
+    if channels_last:
+        # NHWC weights; feed inputs with memory_format=torch.channels_last as well
+        model = model.to(memory_format=torch.channels_last)
     return model
 
 def deeplabv3_resnet50(pretrained=False, progress=True,
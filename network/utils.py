@@ -3,6 +3,7 @@ import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
 from collections import OrderedDict
+from typing import Dict, List
 
 class _SimpleSegmentationModel(nn.Module):
     def __init__(self, backbone, classifier):
@@ -27,6 +28,44 @@ class _SimpleSegmentationModel(nn.Module):
             return x
 
 
+def check_compile():
+    """Raise a clear error when torch.compile is missing, i.e. on PyTorch < 2.0."""
+    if not hasattr(torch, 'compile'):
+        raise RuntimeError('torch.compile needs PyTorch >= 2.0, found %s' % torch.__version__)
+
+
+class TypedSegmentationModel(nn.Module):
+    """
+    _SimpleSegmentationModel with a fixed output type, for torch.jit.script and torch.compile.
+
+    The forward always returns a List[Tensor] whose last entry is the prediction
+    upsampled to the input size: the feature pyramid of DeepLabHeadV3Plus, or a
+    single-element list for DeepLabHead. Backbone and classifier are shared with
+    the wrapped model and keep their parameter names, so checkpoints of the
+    eager model load into this one unchanged.
+    """
+    def __init__(self, backbone, classifier):
+        super(TypedSegmentationModel, self).__init__()
+        self.backbone = backbone
+        self.classifier = classifier
+
+    @classmethod
+    def from_model(cls, model):
+        return cls(model.backbone, model.classifier)
+
+    def forward(self, x: torch.Tensor) -> List[torch.Tensor]:
+        input_shape = x.shape[-2:]
+        features = self.backbone(x)
+        out = self.classifier(features)
+        # resolved statically from the classifier's return type when scripting
+        if isinstance(out, torch.Tensor):
+            outputs = [out]
+        else:
+            outputs = out
+        outputs[-1] = F.interpolate(outputs[-1], size=input_shape, mode='bilinear', align_corners=False)
+        return outputs
+
+
 class IntermediateLayerGetter(nn.ModuleDict):
     """
     Module wrapper that returns intermediate layers from a model
@@ -58,6 +97,8 @@ class IntermediateLayerGetter(nn.ModuleDict):
         >>>     [('feat1', torch.Size([1, 64, 56, 56])),
         >>>      ('feat2', torch.Size([1, 256, 14, 14]))]
     """
+    return_layers: Dict[str, str]
+
     def __init__(self, model, return_layers):
         if not set(return_layers).issubset([name for name, _ in model.named_children()]):
             raise ValueError("return_layers are not present in model")
@@ -75,11 +116,46 @@ class IntermediateLayerGetter(nn.ModuleDict):
         super(IntermediateLayerGetter, self).__init__(layers)
         self.return_layers = orig_return_layers
 
-    def forward(self, x):
+
+    def forward(self, x: torch.Tensor) -> Dict[str, torch.Tensor]:
         out = OrderedDict()
-        for name, module in self.named_children():
+        for name, module in self.items():
             x = module(x)
             if name in self.return_layers:
                 out_name = self.return_layers[name]
                 out[out_name] = x
         return out
+
+
+class GhostBatchNorm2d(nn.BatchNorm2d):
+    """BatchNorm2d that normalizes ``num_splits`` equal chunks of the batch separately.
+
+    In training mode every chunk gets its own batch statistics and updates the
+    running statistics in turn, exactly as if the chunks had been passed through
+    the model in separate calls. Evaluation uses the running statistics as usual.
+    """
+    def __init__(self, num_features, num_splits=2, **kwargs):
+        super(GhostBatchNorm2d, self).__init__(num_features, **kwargs)
+        self.num_splits = num_splits
+
+    def forward(self, input):
+        if not self.training or self.num_splits == 1:
+            return super(GhostBatchNorm2d, self).forward(input)
+        assert input.shape[0] % self.num_splits == 0, 'batch is not divisible into %d ghost batches' % self.num_splits
+        return torch.cat([super(GhostBatchNorm2d, self).forward(chunk)
+                          for chunk in input.chunk(self.num_splits, dim=0)], dim=0)
+
+    def extra_repr(self):
+        return super(GhostBatchNorm2d, self).extra_repr() + ', num_splits={}'.format(self.num_splits)
+
+
+def convert_to_ghost_bn(module, num_splits=2):
+    """Replace every nn.BatchNorm2d in ``module`` by a GhostBatchNorm2d sharing its parameters and buffers."""
+    new_module = module
+    if isinstance(module, nn.BatchNorm2d) and not isinstance(module, GhostBatchNorm2d):
+        new_module = GhostBatchNorm2d(module.num_features, num_splits, eps=module.eps, momentum=module.momentum,
+                                      affine=module.affine, track_running_stats=module.track_running_stats)
+        new_module.load_state_dict(module.state_dict())
+    for name, child in module.named_children():
+        new_module.add_module(name, convert_to_ghost_bn(child, num_splits))
+    return new_module
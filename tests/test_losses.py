@@ -0,0 +1,137 @@
+"""Tests of the batched PGC loss against the reference loops in metrics/losses.py.
+
+Run from the repository root::
+
+    python -m pytest tests
+"""
+import pytest
+import torch
+
+from metrics.losses import (CONSISTENCY_KINDS, PGC_loss, PGCTermLoss, LossTerm, SymmetricConsistency,
+                            build_pgc_terms, gather_overlaps, overlap_consistency)
+
+NUM_PAIRS = 4
+CROP_SIZE = 32
+NUM_CLASSES = 5
+
+
+def random_pairs(generator):
+    """Equal-sized overlap boxes at random places in both views, both flips, and one empty overlap."""
+    overlap, flips = [], []
+    for i in range(NUM_PAIRS):
+        h, w = (int(torch.randint(1, CROP_SIZE + 1, (1,), generator=generator)) for _ in range(2))
+        if i == NUM_PAIRS - 1:
+            h = 0
+        boxes = []
+        for _ in range(2):
+            y, x = (int(torch.randint(0, CROP_SIZE - s + 1, (1,), generator=generator)) for s in (h, w))
+            boxes.append([[y, x], [y + h, x + w]])
+        overlap.append(boxes)
+        flips.append(-1 if i % 2 else 1)
+    return overlap, flips
+
+
+def pgc_inputs(seed=0):
+    """Random DeepLabV3+-like pyramid of both views, overlaps, flips and labels.
+
+    The feature levels have more channels and rows than the scaled boxes
+    reach, which the batch slices of ssp_loss_inner need.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    n, s = NUM_PAIRS, CROP_SIZE
+    shapes = [(64, s // 16 + 1), (48, s // 4 + 1), (48, s // 4 + 1), (NUM_CLASSES, s)]
+    outputs = [[torch.randn(n, c, size, size, generator=generator).requires_grad_() for _ in range(2)]
+               for c, size in shapes]
+    labels = torch.randint(0, NUM_CLASSES, (2 * n, s, s), generator=generator)
+    labels[:, :s // 8] = 255
+    overlap, flips = random_pairs(generator)
+    return outputs, overlap, flips, labels
+
+
+def leaves(outputs):
+    return [t for level in outputs for t in level]
+
+
+def assert_close(actual, expected, name):
+    assert torch.allclose(actual, expected, rtol=1e-4, atol=1e-6), \
+        '%s: %s != %s' % (name, actual.tolist(), expected.tolist())
+
+
+@pytest.mark.parametrize('level_crops', ['batch', 'pair'])
+def test_terms_match_reference(level_crops):
+    outputs, overlap, flips, labels = pgc_inputs()
+    reference = PGC_loss(per_pair=level_crops == 'pair')
+    mse, sym_ce, mid_mse, mid_ce, mid_l1, ce = reference(outputs, overlap, flips, labels)
+
+    terms = [LossTerm('ce', 1.0, 'ce'), LossTerm('mse', 1.0, 'mse'), LossTerm('sym_ce', 1.0, 'sym_ce')]
+    for i in reference.use_pgc:
+        terms.extend(LossTerm('%s%d' % (kind, i), 1.0, kind, level=i, down_rate=reference.down_rate[i])
+                     for kind in CONSISTENCY_KINDS)
+    values = PGCTermLoss(terms, level_crops=level_crops)(outputs, overlap, flips, labels)
+
+    assert_close(values['ce'], ce, 'ce')
+    assert_close(values['mse'], mse, 'mse')
+    assert_close(values['sym_ce'], sym_ce, 'sym_ce')
+    for k, i in enumerate(reference.use_pgc):
+        # ssp_loss_inner adds the mse of every pair twice
+        assert_close(2 * values['mse%d' % i], mid_mse[k], 'mse%d' % i)
+        assert_close(values['sym_ce%d' % i], mid_ce[k], 'sym_ce%d' % i)
+        assert_close(values['l1%d' % i], mid_l1[k], 'l1%d' % i)
+
+
+@pytest.mark.parametrize('level_crops', ['batch', 'pair'])
+def test_loss_and_gradients_match_reference(level_crops):
+    alpha, beta = 0.2, 0.9
+    outputs, overlap, flips, labels = pgc_inputs(seed=1)
+
+    reference = PGC_loss(per_pair=level_crops == 'pair')
+    mse, sym_ce, mid_mse, mid_ce, mid_l1, ce = reference(outputs, overlap, flips, labels)
+    expected = ce + beta * sym_ce + alpha * sum(mid_mse)
+    criterion = PGCTermLoss(build_pgc_terms(alpha=alpha, beta=beta), level_crops=level_crops)
+    loss, _ = criterion.combine(criterion(outputs, overlap, flips, labels))
+    assert_close(loss, expected, 'loss')
+
+    expected_grads = torch.autograd.grad(expected, leaves(outputs), allow_unused=True)
+    grads = torch.autograd.grad(loss, leaves(outputs), allow_unused=True)
+    for k, (g, e) in enumerate(zip(grads, expected_grads)):
+        assert (g is None) == (e is None), 'gradient %d reaches only one of the losses' % k
+        if g is not None:
+            assert_close(g, e, 'gradient %d' % k)
+
+
+def consistency_crops():
+    """Small double precision crops with padding, a flipped pair and an empty pair."""
+    generator = torch.Generator().manual_seed(0)
+    output1, output2 = (torch.randn(3, 5, 6, 7, generator=generator, dtype=torch.float64) for _ in range(2))
+    boxes = torch.tensor([[[[0, 0], [4, 5]], [[1, 2], [5, 7]]],
+                          [[[2, 1], [4, 4]], [[0, 0], [2, 3]]],
+                          [[[3, 3], [3, 6]], [[0, 0], [0, 3]]]])
+    flips = torch.tensor([1, -1, 1])
+    return output1, output2, boxes, flips
+
+
+@pytest.mark.parametrize('with_mse, with_ce', [(True, True), (True, False), (False, True)])
+@pytest.mark.parametrize('ignore_index', [255, 2])
+def test_symmetric_consistency_gradcheck(with_mse, with_ce, ignore_index):
+    crop1, crop2, mask, valid = gather_overlaps(*consistency_crops())
+    crop1, crop2 = crop1.detach().requires_grad_(), crop2.detach().requires_grad_()
+    assert torch.autograd.gradcheck(
+        lambda a, b: SymmetricConsistency.apply(a, b, mask, valid, ignore_index, with_mse, with_ce),
+        (crop1, crop2), eps=1e-6, atol=1e-5)
+
+
+@pytest.mark.parametrize('ignore_index', [255, 2])
+def test_fused_consistency_matches_unfused(ignore_index):
+    output1, output2, boxes, flips = consistency_crops()
+    output1.requires_grad_()
+    output2.requires_grad_()
+    results = []
+    for fused in (False, True):
+        values = overlap_consistency(output1, output2, boxes, flips, ignore_index, ('mse', 'sym_ce'), fused=fused)
+        grads = torch.autograd.grad(values['mse'] + values['sym_ce'], [output1, output2])
+        results.append((values, grads))
+    (values, grads), (fused_values, fused_grads) = results
+    for kind in ('mse', 'sym_ce'):
+        assert_close(fused_values[kind], values[kind], kind)
+    for k, (g, e) in enumerate(zip(fused_grads, grads)):
+        assert_close(g, e, 'gradient of view %d' % (k + 1))
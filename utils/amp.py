@@ -0,0 +1,33 @@
+"""Mixed precision helpers for ``--amp {off,fp16,bf16}``.
+
+``autocast`` wraps the forward pass, ``grad_scaler`` returns a GradScaler
+that is only active for fp16 on CUDA (bf16 has the fp32 exponent range and
+needs no loss scaling). bf16 also runs on CPU; fp16 autocast is CUDA-only.
+The PGC losses cast their inputs back to fp32 themselves.
+"""
+import contextlib
+
+import torch
+
+AMP_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def check_amp(mode, device):
+    if mode not in ('off', 'fp16', 'bf16'):
+        raise ValueError('Unknown amp mode %s, use off, fp16 or bf16' % mode)
+    if mode == 'fp16' and device.type != 'cuda':
+        raise ValueError('--amp fp16 needs a CUDA device, use --amp bf16 on %s' % device.type)
+
+
+def autocast(mode, device):
+    """Context manager running the enclosed ops in ``mode`` precision on ``device``."""
+    check_amp(mode, device)
+    if mode == 'off':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=AMP_DTYPES[mode])
+
+
+def grad_scaler(mode, device):
+    """GradScaler enabled for fp16 on CUDA, a pass-through otherwise."""
+    check_amp(mode, device)
+    return torch.amp.GradScaler('cuda', enabled=(mode == 'fp16' and device.type == 'cuda'))
@@ -0,0 +1,226 @@
+"""Batched, on-device version of the paired-view training augmentation.
+
+The default pipeline runs ``corr_ts.ExtRandomScale``,
+``ExtRandomHorizontalFlip`` and ``New_ExtRandomCrop`` on one PIL image at a
+time inside the loader workers. Here the workers only paste each decoded
+sample into a fixed-size uint8 canvas (``ExtToCanvas`` + ``collate_canvas``);
+``BatchPairedAugment`` then scales, flips and crops both views of the whole
+batch with a single ``grid_sample`` on the training device and computes the
+overlap boxes with tensor arithmetic.
+
+The random parameters follow ``New_ExtRandomCrop`` exactly (padding, crop
+offsets, ``new_cor`` and ``get_overlaps`` rounding), so the overlaps agree
+with what the PIL pipeline would report for the same draws. Resampling is
+plain bilinear without PIL's antialiasing on downscale.
+"""
+import numbers
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class ExtToCanvas(object):
+    """Paste an image/label pair into the top-left corner of a fixed-size uint8 canvas.
+
+    Returns the canvases together with the valid ``(h, w)`` so that
+    ``BatchPairedAugment`` can ignore the padding.
+
+    Args:
+        size (sequence or int): Canvas size (h, w). Must be at least as large as every image.
+    """
+
+    def __init__(self, size):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = tuple(size)
+
+    def __call__(self, img, lbl):
+        w, h = img.size
+        ch, cw = self.size
+        if h > ch or w > cw:
+            raise ValueError('Image of size %dx%d does not fit into a %dx%d canvas, increase --canvas_size' % (h, w, ch, cw))
+        image = torch.zeros((3, ch, cw), dtype=torch.uint8)
+        label = torch.zeros((ch, cw), dtype=torch.uint8)
+        image[:, :h, :w] = torch.from_numpy(np.array(img, dtype=np.uint8).transpose(2, 0, 1))
+        label[:h, :w] = torch.from_numpy(np.array(lbl, dtype=np.uint8))
+        return image, label, torch.tensor([h, w], dtype=torch.int64)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(size={0})'.format(self.size)
+
+
+def collate_canvas(batchs):
+    images, labels, sizes = zip(*batchs)
+    return torch.stack(images), torch.stack(labels), torch.stack(sizes)
+
+
+class BatchPairedAugment(object):
+    """Random scale, horizontal flip and crop of two views per sample, batched.
+
+    Args:
+        crop_size (sequence or int): Output size (h, w) of every view.
+        scale_range (tuple): Range of the random scale, shared by both views of a sample.
+        p (float): Probability of flipping each view.
+        mean (sequence): Per-channel mean used to normalize the output images.
+        std (sequence): Per-channel std used to normalize the output images.
+        num_copys (int): Number of views per sample. The overlap bookkeeping supports 2.
+        label_map (sequence, optional): Table from the canvas label values to the training
+            labels, applied on the device after sampling, e.g. Cityscapes labelIds to trainIds.
+        label_fill (int): Label of the pixels outside the scaled image. 0 is what ``F.pad``
+            gives the PIL pipeline; use 255 (ignore) when 0 is a real class.
+        jitter (tuple, optional): ``(brightness, contrast, saturation)`` of a color jitter
+            drawn per view like ``ExtColorJitter``, applied after the crop in that fixed order.
+
+    Call with the canvas batch ``(images uint8 [B, 3, H, W], labels uint8 [B, H, W],
+    sizes int [B, 2])``. Returns ``(images, labels, overlaps, flips)`` laid out like
+    ``collate_fn2``: views interleaved as ``[2B, 3, h, w]`` float images and
+    ``[2B, h, w]`` long labels, ``overlaps`` as an int64 tensor ``[B, 2, 2, 2]`` of
+    ``((up, left), (down, right))`` boxes per view and ``flips`` as an int64 tensor
+    ``[B]`` holding the relative flip (1 or -1) between the two views.
+    """
+
+    def __init__(self, crop_size, scale_range=(0.5, 2.0), p=0.5,
+                 mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), num_copys=2,
+                 label_map=None, label_fill=0, jitter=None):
+        if isinstance(crop_size, numbers.Number):
+            self.crop_size = (int(crop_size), int(crop_size))
+        else:
+            self.crop_size = tuple(crop_size)
+        assert num_copys == 2, 'overlaps are defined between exactly two views'
+        self.scale_range = scale_range
+        self.p = p
+        self.mean = mean
+        self.std = std
+        self.num_copys = num_copys
+        self.label_map = None if label_map is None else torch.as_tensor(np.asarray(label_map, dtype=np.uint8))
+        self.label_fill = label_fill
+        self.jitter = jitter
+
+    def get_params(self, sizes):
+        """Draw scale, flips and crop offsets and compute ``new_cor`` for every view.
+
+        Mirrors ``New_ExtRandomCrop.micro_call`` with ``pad_if_needed=True``.
+        Everything is ``[B, V]`` float64 so that rounding matches the Python code.
+        """
+        device = sizes.device
+        B, V = sizes.shape[0], self.num_copys
+        ch, cw = self.crop_size
+        H = sizes[:, 0].double()[:, None].expand(B, V)
+        W = sizes[:, 1].double()[:, None].expand(B, V)
+
+        scale = torch.empty(B, 1, dtype=torch.float64, device=device).uniform_(*self.scale_range).expand(B, V)
+        Hs, Ws = torch.floor(H * scale), torch.floor(W * scale)
+        pad_w = torch.where(Ws < cw, torch.floor((1 + cw - Ws) / 2), torch.zeros_like(Ws))
+        # the height check runs on the image that was already padded for the width
+        pad_h = torch.where(Hs + 2 * pad_w < ch, torch.floor((1 + ch - Hs - 2 * pad_w) / 2), torch.zeros_like(Hs))
+        pad = pad_w + pad_h
+        i = torch.floor(torch.rand(B, V, dtype=torch.float64, device=device) * (Hs + 2 * pad - ch + 1))
+        j = torch.floor(torch.rand(B, V, dtype=torch.float64, device=device) * (Ws + 2 * pad - cw + 1))
+        flip = torch.rand(B, V, device=device) < self.p
+
+        y_min = torch.clamp(pad - i, min=0)
+        x_min = torch.clamp(pad - j, min=0)
+        Y_min = torch.clamp(i - pad, min=0)
+        X_min = torch.clamp(j - pad, min=0)
+        y_max = torch.clamp(Hs + pad - i, max=ch)
+        x_max = torch.clamp(Ws + pad - j, max=cw)
+        Y_max = torch.min(Hs, i + y_max - pad)
+        X_max = torch.min(Ws, j + x_max - pad)
+        X_min, X_max = torch.where(flip, Ws - X_max, X_min), torch.where(flip, Ws - X_min, X_max)
+        return {'H': H, 'W': W, 'Hs': Hs, 'Ws': Ws, 'pad': pad, 'i': i, 'j': j, 'flip': flip,
+                'cur': (y_min, x_min, y_max, x_max), 'ori': (Y_min, X_min, Y_max, X_max)}
+
+    @staticmethod
+    def get_overlaps(params):
+        """Vectorized ``New_ExtRandomCrop.get_overlaps``."""
+        y_min, x_min, y_max, x_max = params['cur']
+        Y_min, X_min, Y_max, X_max = params['ori']
+        up = Y_min.max(dim=1, keepdim=True)[0]
+        left = X_min.max(dim=1, keepdim=True)[0]
+        down = Y_max.min(dim=1, keepdim=True)[0]
+        right = X_max.min(dim=1, keepdim=True)[0]
+
+        size_y, size_x = y_max - y_min, x_max - x_min
+        ext_y = torch.clamp(Y_max - Y_min, min=1)
+        ext_x = torch.clamp(X_max - X_min, min=1)
+        top = torch.round(y_min + size_y * (up - Y_min) / ext_y)
+        bottom = torch.round(y_min + size_y * (down - Y_min) / ext_y)
+        flip = params['flip']
+        left_x = torch.where(flip, x_min + size_x * (1 - (right - X_min) / ext_x), x_min + size_x * (left - X_min) / ext_x)
+        right_x = torch.where(flip, x_min + size_x * (1 - (left - X_min) / ext_x), x_min + size_x * (right - X_min) / ext_x)
+
+        overlaps = torch.stack([torch.stack([top, torch.round(left_x)], dim=-1),
+                                torch.stack([bottom, torch.round(right_x)], dim=-1)], dim=2)
+        signs = torch.where(flip, -torch.ones_like(flip, dtype=torch.int64), torch.ones_like(flip, dtype=torch.int64))
+        return overlaps.long(), signs.prod(dim=1)
+
+    def _grid(self, params, canvas_h, canvas_w):
+        ch, cw = self.crop_size
+        device = params['i'].device
+        ys = (params['i'] - params['pad']).reshape(-1, 1) + torch.arange(ch, device=device, dtype=torch.float64)
+        xs = (params['j'] - params['pad']).reshape(-1, 1) + torch.arange(cw, device=device, dtype=torch.float64)
+        Hs, Ws = params['Hs'].reshape(-1, 1), params['Ws'].reshape(-1, 1)
+        H, W = params['H'].reshape(-1, 1), params['W'].reshape(-1, 1)
+        valid = ((ys >= 0) & (ys < Hs))[:, :, None] & ((xs >= 0) & (xs < Ws))[:, None, :]
+
+        # flipping happens before the crop, so mirror inside the scaled image
+        xs = torch.where(params['flip'].reshape(-1, 1), Ws - 1 - xs, xs)
+        # pixel-center mapping of a resize, clamped to the image like PIL does at the border
+        yo = torch.min(torch.clamp((ys + 0.5) * H / Hs - 0.5, min=0), H - 1)
+        xo = torch.min(torch.clamp((xs + 0.5) * W / Ws - 0.5, min=0), W - 1)
+        gy = (2 * yo + 1) / canvas_h - 1
+        gx = (2 * xo + 1) / canvas_w - 1
+        grid = torch.stack([gx[:, None, :].expand(-1, ch, -1), gy[:, :, None].expand(-1, -1, cw)], dim=-1)
+        return grid.float(), valid
+
+    def __call__(self, images, labels, sizes):
+        B, _, canvas_h, canvas_w = images.shape
+        V = self.num_copys
+        params = self.get_params(sizes)
+        overlaps, flips = self.get_overlaps(params)
+        grid, valid = self._grid(params, canvas_h, canvas_w)
+
+        src = images.float().repeat_interleave(V, dim=0)
+        out = F.grid_sample(src, grid, mode='bilinear', padding_mode='border', align_corners=False)
+        lbl = labels[:, None].float().repeat_interleave(V, dim=0)
+        lbl = F.grid_sample(lbl, grid, mode='nearest', padding_mode='border', align_corners=False)[:, 0]
+        # outside the scaled image both views were zero-padded by F.pad
+        out = out * valid[:, None]
+        lbl = lbl.long()
+        if self.label_map is not None:
+            lbl = self.label_map.to(lbl.device)[lbl].long()
+        lbl = torch.where(valid, lbl, torch.full_like(lbl, self.label_fill))
+        if self.jitter is not None:
+            out = self.color_jitter(out)
+
+        mean = torch.as_tensor(self.mean, dtype=out.dtype, device=out.device).view(1, -1, 1, 1)
+        std = torch.as_tensor(self.std, dtype=out.dtype, device=out.device).view(1, -1, 1, 1)
+        out = (out / 255. - mean) / std
+        return out, lbl, overlaps, flips
+
+    def color_jitter(self, images):
+        """Brightness, contrast and saturation with factors drawn per view, on [0, 255] images."""
+        brightness, contrast, saturation = self.jitter
+        n = images.shape[0]
+
+        def factors(amount):
+            return torch.empty(n, 1, 1, 1, device=images.device).uniform_(max(0., 1 - amount), 1 + amount)
+
+        def gray(x):
+            return (0.299 * x[:, 0:1] + 0.587 * x[:, 1:2] + 0.114 * x[:, 2:3])
+
+        if brightness:
+            images = (images * factors(brightness)).clamp(0, 255)
+        if contrast:
+            mean = gray(images).mean(dim=(1, 2, 3), keepdim=True)
+            images = (mean + factors(contrast) * (images - mean)).clamp(0, 255)
+        if saturation:
+            g = gray(images)
+            images = (g + factors(saturation) * (images - g)).clamp(0, 255)
+        return images
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(crop_size={0}, scale_range={1}, p={2})'.format(
+            self.crop_size, self.scale_range, self.p)
@@ -0,0 +1,112 @@
+"""Background checkpoint writer.
+
+``CheckpointWriter.save`` copies the state to CPU on the calling thread and
+hands it to a worker thread that serializes it. Every checkpoint is written
+to a temporary file, fsynced and renamed into place, so a crash never leaves
+a truncated file behind. Files are named ``<name>_itr<step>.pth``; the newest
+``keep`` of them are kept, and aliases such as ``latest_...pth`` or
+``best_...pth`` are hard links to the newest file of their kind.
+"""
+import os
+import re
+import copy
+import queue
+import threading
+
+import torch
+
+
+def to_cpu(obj):
+    """Deep copy of ``obj`` with every tensor copied to CPU memory."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def _replace_with_link(src, dst):
+    tmp = dst + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        # file systems without hard links get a copy
+        with open(src, 'rb') as fi, open(tmp, 'wb') as fo:
+            fo.write(fi.read())
+    os.replace(tmp, dst)
+
+
+class CheckpointWriter(object):
+    """Write checkpoints on a background thread.
+
+    Args:
+        directory (str): Output directory, created if missing.
+        keep (int): Number of ``<name>_itr<step>.pth`` files kept per name, at least 1.
+        max_pending (int): Snapshots that may wait for the writer before ``save`` blocks.
+    """
+
+    def __init__(self, directory, keep=3, max_pending=2):
+        if keep < 1:
+            raise ValueError('keep must be at least 1, got %d' % keep)
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def save(self, state, name, step, aliases=()):
+        """Snapshot ``state`` to CPU and queue it as ``<name>_itr<step>.pth``.
+
+        Only the device-to-host copy happens on the calling thread. Every entry
+        of ``aliases`` becomes ``<alias>.pth`` pointing at the same file, so one
+        snapshot serves both the latest and the best checkpoint.
+        """
+        self._check()
+        self._queue.put((to_cpu(state), name, step, tuple(aliases)))
+
+    def close(self):
+        """Wait for all queued checkpoints to be written."""
+        self._queue.put(None)
+        self._thread.join()
+        self._check()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('checkpoint writer failed') from error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, state, name, step, aliases):
+        path = os.path.join(self.directory, '%s_itr%d.pth' % (name, step))
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        for alias in aliases:
+            _replace_with_link(path, os.path.join(self.directory, alias + '.pth'))
+        print("Model saved as %s" % path)
+        self._rotate(name)
+
+    def _rotate(self, name):
+        pattern = re.compile(re.escape(name) + r'_itr(\d+)\.pth$')
+        steps = sorted((int(m.group(1)), f) for f in os.listdir(self.directory)
+                       for m in [pattern.match(f)] if m)
+        for _, f in steps[:-self.keep]:
+            os.remove(os.path.join(self.directory, f))
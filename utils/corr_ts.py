@@ -11,6 +11,17 @@ from PIL import Image
 #  Extended Transforms for Semantic Segmentation
 #
 
+def draft_decode(img, size):
+	"""Decode ``img`` to RGB for a later resize to ``size`` (h, w).
+	For a not yet decoded JPEG that is being downscaled, ``Image.draft`` lets libjpeg
+	skip DCT coefficients (1/2, 1/4 or 1/8 scale). It never goes below ``size``, so the
+	caller still resizes to exactly ``size`` and all coordinates stay unchanged.
+	"""
+	if getattr(img, 'format', None) == 'JPEG' and size[0] < img.size[1] and size[1] < img.size[0]:
+		img.draft('RGB', (size[1], size[0]))
+	return img.convert('RGB')
+
+
 class ExtRandomHorizontalFlip(object):
 	"""Horizontally flip the given PIL Image randomly with a given probability.
 
@@ -126,14 +137,16 @@ class ExtCenterCrop(object):
 
 
 class ExtRandomScale(object):
-	def __init__(self, scale_range, interpolation=Image.BILINEAR):
+	def __init__(self, scale_range, interpolation=Image.BILINEAR, draft=False):
 		self.scale_range = scale_range
 		self.interpolation = interpolation
+		self.draft = draft
 
 	def __call__(self, img, lbl, ori_cor=None):
 		"""
 		Args:
-			img (PIL Image): Image to be scaled.
+			img (PIL Image): Image to be scaled. With ``draft=True`` it may be a JPEG that was
+				opened but not decoded yet; it is then decoded at reduced size when downscaling.
 			lbl (PIL Image): Label to be scaled.
 		Returns:
 			PIL Image: Rescaled image.
@@ -146,6 +159,8 @@ class ExtRandomScale(object):
 		flip = 1 if ori_cor is None else ori_cor[-1]
 		ori_cor = [0, 0, img_size[0], img_size[1], 0, 0, target_size[1], target_size[0], scale, flip]
 		ori_cor = [ori_cor, ori_cor.copy()]
+		if self.draft:
+			img = draft_decode(img, target_size)
 		image = F.resize(img, target_size, self.interpolation)
 		label = F.resize(lbl, target_size, Image.NEAREST)
 		return [image, image.copy()], [label, label.copy()], ori_cor
@@ -385,6 +400,25 @@ class ExtToTensor(object):
 		return self.__class__.__name__ + '()'
 
 
+class ExtToByteTensor(object):
+	"""Convert every view (``PIL Image``) to a uint8 tensor of shape (C x H x W) without scaling.
+	Conversion to float and normalization are left to ``utils.DeviceNormalize``
+	on the training device, so the loader ships a quarter of the bytes.
+	"""
+
+	def __call__(self, pics, lbls, cor=None):
+		images = []
+		labels = []
+		for i in range(len(pics)):
+			img = np.ascontiguousarray(np.array(pics[i], dtype=np.uint8).transpose(2, 0, 1))
+			images.append(torch.from_numpy(img))
+			labels.append(torch.from_numpy(np.array(lbls[i], dtype=np.uint8)))
+		return images, labels, cor
+
+	def __repr__(self):
+		return self.__class__.__name__ + '()'
+
+
 class ExtNormalize(object):
 	"""Normalize a tensor image with mean and standard deviation.
 	Given mean: ``(M1,...,Mn)`` and std: ``(S1,..,Sn)`` for ``n`` channels, this transform
@@ -499,15 +533,18 @@ class New_ExtRandomCrop(object):
 			respectively.
 		pad_if_needed (boolean): It will pad the image if smaller than the
 			desired size to avoid raising an exception.
+		label_fill (int): Label of the padded pixels. Default is 0; use 255 (ignore)
+			for labels where 0 is a class, e.g. Cityscapes train ids.
 	"""
 
-	def __init__(self, size, padding=0, pad_if_needed=False):
+	def __init__(self, size, padding=0, pad_if_needed=False, label_fill=0):
 		if isinstance(size, numbers.Number):
 			self.size = (int(size), int(size))
 		else:
 			self.size = size
 		self.padding = padding
 		self.pad_if_needed = pad_if_needed
+		self.label_fill = label_fill
 
 	@staticmethod
 	def get_params(img, output_size):
@@ -527,6 +564,33 @@ class New_ExtRandomCrop(object):
 		j = random.randint(0, w - tw)
 		return i, j, th, tw
 
+	@staticmethod
+	def get_cor(size_x, size_y, pad, i, j, h, w, scale, flip):
+		"""Bookkeeping of one cropped view.
+		Args:
+			size_x, size_y (int): Size of the (scaled) image before padding.
+			pad (int): Padding added on every side before cropping.
+			i, j, h, w (int): Crop window in the padded image.
+			scale (float): Scale applied to the image.
+			flip (int): 1, or -1 if the image was flipped before cropping.
+		Returns:
+			list: ``[y_min, x_min, y_max, x_max]`` valid region in the crop, ``[Y_min, X_min, Y_max, X_max]``
+			the same region in unflipped image coordinates, followed by ``size_y, size_x, scale, flip``.
+		"""
+		y_min = max(pad - i, 0)
+		x_min = max(pad - j, 0)
+		Y_min = max(i - pad, 0)
+		X_min = max(j - pad, 0)
+		y_max = min(size_y + pad - i, h)
+		x_max = min(size_x + pad - j, w)
+		Y_max = min(size_y, i + y_max - pad)
+		X_max = min(size_x, j + x_max - pad)
+
+		if flip == -1:
+			X_max, X_min = size_x - X_min, size_x - X_max
+
+		return [y_min, x_min, y_max, x_max, Y_min, X_min, Y_max, X_max, size_y, size_x, scale, flip]
+
 	def micro_call(self, img, lbl, ori_cor):
 
 
@@ -536,13 +600,13 @@ class New_ExtRandomCrop(object):
 		translate = torch.Tensor([0., 0.])
 		if self.padding > 0:
 			img = F.pad(img, self.padding)
-			lbl = F.pad(lbl, self.padding)
+			lbl = F.pad(lbl, self.padding, fill=self.label_fill)
 
 		# pad the width if needed
 		if self.pad_if_needed and img.size[0] < self.size[1]:
 			pad_w = int((1 + self.size[1] - img.size[0]) / 2)
 			img = F.pad(img, padding=pad_w)
-			lbl = F.pad(lbl, padding=pad_w)
+			lbl = F.pad(lbl, padding=pad_w, fill=self.label_fill)
 		else:
 			pad_w = 0
 
@@ -550,7 +614,7 @@ class New_ExtRandomCrop(object):
 		if self.pad_if_needed and img.size[1] < self.size[0]:
 			pad_h = int((1 + self.size[0] - img.size[1]) / 2)
 			img = F.pad(img, padding=pad_h)
-			lbl = F.pad(lbl, padding=pad_h)
+			lbl = F.pad(lbl, padding=pad_h, fill=self.label_fill)
 		else:
 			pad_h = 0
 
@@ -558,28 +622,8 @@ class New_ExtRandomCrop(object):
 		i, j, h, w = self.get_params(img, self.size)
 		# print('i = {:}, j = {:}, h = {:}, w = {:}, pad = {:}'.format(i, j, h, w, pad))
 		scale = ori_cor[-2] if ori_cor is not None else 1.
-		y_min = max(pad - i, 0)
-		x_min = max(pad - j, 0)
-		Y_min = max(i - pad, 0)
-		X_min = max(j - pad, 0)
-		y_max = min(size_y + pad - i, h)
-		x_max = min(size_x + pad - j, w)
-		Y_max = min(size_y, i + y_max - pad)
-		X_max = min(size_x, j + x_max - pad)
-
-		import math
-		# X_min, X_max, Y_min, Y_max = round(X_min / scale), round(X_max), round(Y_min / scale), round(Y_max)
 		flip = ori_cor[-1] if ori_cor is not None else 1
-
-		if flip == -1:
-			X_max, X_min = size_x - X_min, size_x - X_max
-
-		# Y_min = round(Y_min / scale)
-		# Y_max = round(Y_max / scale)
-		# X_min = round(X_min / scale)
-		# X_max = round(X_max / scale)
-
-		new_cor = [y_min, x_min, y_max, x_max, Y_min, X_min, Y_max, X_max, size_y, size_x, scale, flip]
+		new_cor = self.get_cor(size_x, size_y, pad, i, j, h, w, scale, flip)
 		# print(new_cor)
 		# print('y_min = {:}, x_min = {:}, y_max = {:},'
 		#       'x_max = {:}, Y_min = {:}, X_min = {:},'
@@ -653,6 +697,91 @@ class New_ExtRandomCrop(object):
 		return self.__class__.__name__ + '(size={0}, padding={1})'.format(self.size, self.padding)
 
 
+class ExtRandomScaledCrop(New_ExtRandomCrop):
+	"""Fused ``ExtRandomScale`` + ``ExtRandomHorizontalFlip`` + ``New_ExtRandomCrop``.
+	Instead of resizing the whole image for every view and keeping only a crop of it,
+	each crop window is mapped back to source coordinates and only that region is
+	resampled, once per view. Random draws happen in the same order as in the unfused
+	chain and the ``new_cor``/overlap bookkeeping is shared with ``New_ExtRandomCrop``,
+	so ``get_overlaps`` and ``PGC_loss`` see the same overlaps.
+	Args:
+		scale_range (tuple): Range of the random scale, shared by all views.
+		size (sequence or int): Desired output size of the crop.
+		p (float): Probability of flipping each view.
+		pad_if_needed (boolean): Zero-pad the scaled image if smaller than the crop.
+		num_copys (int): Number of views to produce.
+		draft (boolean): Decode a not yet decoded JPEG at reduced size when downscaling.
+		label_fill (int): Label of the padded pixels, as in ``New_ExtRandomCrop``.
+	"""
+
+	def __init__(self, scale_range, size, p=0.5, pad_if_needed=False, num_copys=2, interpolation=Image.BILINEAR,
+	             draft=False, label_fill=0):
+		super(ExtRandomScaledCrop, self).__init__(size, padding=0, pad_if_needed=pad_if_needed, label_fill=label_fill)
+		self.scale_range = scale_range
+		self.p = p
+		self.num_copys = num_copys
+		self.interpolation = interpolation
+		self.draft = draft
+
+	def get_pad(self, size_x, size_y):
+		"""Padding ``micro_call`` would add to an image of this size."""
+		pad_w = pad_h = 0
+		if self.pad_if_needed and size_x < self.size[1]:
+			pad_w = int((1 + self.size[1] - size_x) / 2)
+		if self.pad_if_needed and size_y + 2 * pad_w < self.size[0]:
+			pad_h = int((1 + self.size[0] - size_y - 2 * pad_w) / 2)
+		return pad_w + pad_h
+
+	def resample_view(self, img, lbl, new_cor):
+		th, tw = self.size
+		y_min, x_min, y_max, x_max, Y_min, X_min, Y_max, X_max, size_y, size_x, scale, flip = new_cor
+		image = Image.new(img.mode, (tw, th))
+		label = Image.new(lbl.mode, (tw, th), self.label_fill)
+		if lbl.mode == 'P':
+			label.putpalette(lbl.getpalette())
+		if y_max > y_min and x_max > x_min:
+			# image and label sizes differ after a draft decode, so each gets its own box
+			def box(im):
+				w, h = im.size
+				return X_min * w / size_x, Y_min * h / size_y, X_max * w / size_x, Y_max * h / size_y
+			region = img.resize((x_max - x_min, y_max - y_min), self.interpolation, box=box(img))
+			region_lbl = lbl.resize((x_max - x_min, y_max - y_min), Image.NEAREST, box=box(lbl))
+			if flip == -1:
+				region, region_lbl = F.hflip(region), F.hflip(region_lbl)
+			image.paste(region, (x_min, y_min))
+			label.paste(region_lbl, (x_min, y_min))
+		return image, label
+
+	def __call__(self, img, lbl, ori_cor=None):
+		assert img.size == lbl.size
+		th, tw = self.size
+		scale = random.uniform(self.scale_range[0], self.scale_range[1])
+		size_x, size_y = int(img.size[0] * scale), int(img.size[1] * scale)
+		if self.draft:
+			img = draft_decode(img, (size_y, size_x))
+		flips = [-1 if random.random() < self.p else 1 for _ in range(self.num_copys)]
+		pad = self.get_pad(size_x, size_y)
+		h, w = size_y + 2 * pad, size_x + 2 * pad
+
+		imgs, labels, cur_cors, Ori_cors = [], [], [], []
+		for flip in flips:
+			if w == tw and h == th:
+				i, j = 0, 0
+			else:
+				i, j = random.randint(0, h - th), random.randint(0, w - tw)
+			new_cor = self.get_cor(size_x, size_y, pad, i, j, th, tw, scale, flip)
+			image, label = self.resample_view(img, lbl, new_cor)
+			imgs.append(image)
+			labels.append(label)
+			cur_cors.append(new_cor[:4])
+			Ori_cors.append(new_cor[4:8])
+		overlaps = self.get_overlaps(cur_cors, Ori_cors, flips=flips)
+		return imgs, labels, overlaps
+
+	def __repr__(self):
+		return self.__class__.__name__ + '(scale_range={0}, size={1}, p={2})'.format(self.scale_range, self.size, self.p)
+
+
 class ExtResize(object):
 	"""Resize the input PIL Image to the given size.
 	Args:
@@ -760,17 +889,19 @@ class ExtColorJitter(object):
 		transform = Compose(transforms)
 		return transform
 
-	def __call__(self, img, lbl):
+	def __call__(self, imgs, lbls, ori_cors):
 		"""
 		Args:
-			img (PIL Image): Input image.
+			imgs (list of PIL Image): Input views, each jittered with its own parameters.
 
 		Returns:
-			PIL Image: Color jittered image.
+			list of PIL Image: Color jittered views.
 		"""
-		transform = self.get_params(self.brightness, self.contrast,
-		                            self.saturation, self.hue)
-		return transform(img), lbl
+		for i in range(len(imgs)):
+			transform = self.get_params(self.brightness, self.contrast,
+			                            self.saturation, self.hue)
+			imgs[i] = transform(imgs[i])
+		return imgs, lbls, ori_cors
 
 	def __repr__(self):
 		format_string = self.__class__.__name__ + '('
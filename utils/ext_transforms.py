@@ -3,9 +3,19 @@ import torch
 import torchvision.transforms.functional as F
 import random 
 import numbers
+import collections.abc
 import numpy as np
 from PIL import Image
 
+_pil_interpolation_to_str = {
+    Image.NEAREST: 'PIL.Image.NEAREST',
+    Image.BILINEAR: 'PIL.Image.BILINEAR',
+    Image.BICUBIC: 'PIL.Image.BICUBIC',
+    Image.LANCZOS: 'PIL.Image.LANCZOS',
+    Image.HAMMING: 'PIL.Image.HAMMING',
+    Image.BOX: 'PIL.Image.BOX',
+}
+
 
 #
 #  Extended Transforms for Semantic Segmentation
@@ -113,7 +123,7 @@ class ExtRandomScale(object):
 
     def __repr__(self):
         interpolate_str = _pil_interpolation_to_str[self.interpolation]
-        return self.__class__.__name__ + '(size={0}, interpolation={1})'.format(self.size, interpolate_str)
+        return self.__class__.__name__ + '(scale_range={0}, interpolation={1})'.format(self.scale_range, interpolate_str)
 
 class ExtScale(object):
     """Resize the input PIL Image to the given scale.
@@ -142,7 +152,7 @@ class ExtScale(object):
 
     def __repr__(self):
         interpolate_str = _pil_interpolation_to_str[self.interpolation]
-        return self.__class__.__name__ + '(size={0}, interpolation={1})'.format(self.size, interpolate_str)
+        return self.__class__.__name__ + '(scale={0}, interpolation={1})'.format(self.scale, interpolate_str)
 
 
 class ExtRandomRotation(object):
@@ -296,6 +306,18 @@ class ExtToTensor(object):
     def __repr__(self):
         return self.__class__.__name__ + '()'
 
+class ExtToByteTensor(object):
+    """Convert a ``PIL Image`` to a uint8 tensor of shape (C x H x W) without scaling.
+    Conversion to float and normalization are left to ``utils.DeviceNormalize``
+    on the training device, so the loader ships a quarter of the bytes.
+    """
+    def __call__(self, pic, lbl):
+        img = np.ascontiguousarray(np.array(pic, dtype=np.uint8).transpose(2, 0, 1))
+        return torch.from_numpy(img), torch.from_numpy(np.array(lbl, dtype=np.uint8))
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
 class ExtNormalize(object):
     """Normalize a tensor image with mean and standard deviation.
     Given mean: ``(M1,...,Mn)`` and std: ``(S1,..,Sn)`` for ``n`` channels, this transform
@@ -410,7 +432,7 @@ class ExtResize(object):
     """
 
     def __init__(self, size, interpolation=Image.BILINEAR):
-        assert isinstance(size, int) or (isinstance(size, collections.Iterable) and len(size) == 2)
+        assert isinstance(size, int) or (isinstance(size, collections.abc.Iterable) and len(size) == 2)
         self.size = size
         self.interpolation = interpolation
 
@@ -0,0 +1,103 @@
+"""Benchmark-driven choice of DataLoader worker settings.
+
+``autotune`` times the real dataset and collate function under a few
+``num_workers`` / ``prefetch_factor`` / ``persistent_workers`` combinations
+and keeps the one with the highest samples/sec. Results are stored per host
+in a small JSON file, so the benchmark only runs the first time a given
+pipeline is used on a machine.
+"""
+import os
+import json
+import time
+import socket
+import itertools
+
+import torch
+import torch.utils.data as data
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'pgc', 'loader_tune.json')
+
+
+def candidate_settings(max_workers=None, persistent=True):
+    """Worker counts up to the number of CPUs, each with a few prefetch depths.
+
+    ``persistent=False`` leaves out ``persistent_workers``, which keeps the
+    dataset copies of the first epoch alive in the workers.
+    """
+    cpus = os.cpu_count() or 1
+    max_workers = min(max_workers or cpus, cpus)
+    workers = sorted(set([0] + [w for w in (2, 4, 8, 12, 16, 24, 32) if w <= max_workers] + [max_workers]))
+    settings = [{'num_workers': 0}]
+    for w, prefetch, persistent in itertools.product(workers[1:], (2, 4), (False, True) if persistent else (False,)):
+        settings.append({'num_workers': w, 'prefetch_factor': prefetch, 'persistent_workers': persistent})
+    return settings
+
+
+def measure(dataset, loader_kwargs, settings, num_batches=20, epochs=2):
+    """Samples/sec of ``num_batches`` batches per epoch over ``epochs`` fresh iterators.
+
+    Re-creating the iterator charges worker start-up to every epoch unless
+    ``persistent_workers`` keeps them alive, which is what the flag saves.
+    """
+    loader = data.DataLoader(dataset, **loader_kwargs, **settings)
+    samples = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for batch in itertools.islice(loader, num_batches):
+            first = batch[0]
+            samples += first.shape[0] if torch.is_tensor(first) else len(first)
+    elapsed = time.perf_counter() - start
+    del loader
+    return samples / elapsed
+
+
+def _load(cache_path):
+    if not os.path.isfile(cache_path):
+        return {}
+    with open(cache_path, 'r') as f:
+        return json.load(f)
+
+
+def _save(cache_path, cache):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tmp = cache_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp, cache_path)
+
+
+def autotune(dataset, loader_kwargs, key, cache_path=None, num_batches=20, max_workers=None):
+    """Return the fastest DataLoader settings for ``dataset``, cached per host under ``key``.
+
+    Args:
+        dataset: The dataset the loader will read.
+        loader_kwargs (dict): Fixed DataLoader arguments (batch_size, collate_fn, shuffle, ...).
+        key (str): Identifies the pipeline, e.g. dataset, split, batch size and transform flags.
+        cache_path (str, optional): JSON file holding the results. Default: ``~/.cache/pgc/loader_tune.json``.
+        num_batches (int): Batches timed per epoch for each candidate.
+        max_workers (int, optional): Upper bound on ``num_workers``.
+
+    Datasets with ``set_epoch`` never get ``persistent_workers``: the workers
+    would keep the epoch they were started with.
+    """
+    cache_path = cache_path or DEFAULT_CACHE
+    host = socket.gethostname()
+    persistent = not hasattr(dataset, 'set_epoch')
+    cache = _load(cache_path)
+    best = cache.get(host, {}).get(key)
+    if best is not None and (persistent or not best['settings'].get('persistent_workers')):
+        print('Loader settings for %s (cached, %s): %s' % (key, host, best['settings']))
+        return best['settings']
+
+    results = []
+    for settings in candidate_settings(max_workers, persistent=persistent):
+        rate = measure(dataset, loader_kwargs, settings, num_batches=num_batches)
+        print('  %s: %.1f samples/s' % (settings, rate))
+        results.append((rate, settings))
+    rate, settings = max(results, key=lambda r: r[0])
+    print('Loader settings for %s (tuned, %s): %s, %.1f samples/s' % (key, host, settings, rate))
+
+    cache = _load(cache_path)
+    cache.setdefault(host, {})[key] = {'settings': settings, 'samples_per_sec': rate}
+    _save(cache_path, cache)
+    return settings
@@ -1,4 +1,5 @@
 from torchvision.transforms.functional import normalize
+import torch
 import torch.nn as nn
 import numpy as np
 import os 
@@ -23,6 +24,24 @@ class Denormalize(object):
             return (tensor - self._mean.reshape(-1,1,1)) / self._std.reshape(-1,1,1)
         return normalize(tensor, self._mean, self._std)
 
+class DeviceNormalize(object):
+    """Normalize a uint8 (N, C, H, W) batch where it lives: ``(x / 255 - mean) / std``.
+    Counterpart of ``ExtToByteTensor``, applied after the batch was moved to the device.
+    """
+    def __init__(self, mean, std):
+        self.mean = mean
+        self.std = std
+        self._stats = {}
+
+    def __call__(self, images):
+        stats = self._stats.get(images.device)
+        if stats is None:
+            mean = torch.tensor(self.mean, dtype=torch.float32, device=images.device).view(1, -1, 1, 1)
+            std = torch.tensor(self.std, dtype=torch.float32, device=images.device).view(1, -1, 1, 1)
+            stats = self._stats[images.device] = (mean * 255, std * 255)
+        mean, std = stats
+        return (images.float() - mean) / std
+
 def set_bn_momentum(model, momentum=0.1):
     for m in model.modules():
         if isinstance(m, nn.BatchNorm2d):